@@ -0,0 +1,68 @@
+"""Ledger of the Asana work already created for each SKU.
+
+Every F1 row attached to a "BOL F1s to be completed" task and every "NEW F1's Needed" subtask
+is recorded with a hash of its content. A rerun of the Asana step then only sends the rows and
+subtasks that are new or changed, instead of duplicating everything created earlier.
+"""
+import hashlib
+import json
+import time
+
+import storage
+
+# Kinds of entries in the ledger
+F1_ROW = "f1_row"
+NEW_F1_SUBTASK = "new_f1_subtask"
+
+
+def _create_tables(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS entries (
+            kind TEXT NOT NULL,
+            sku TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            task_gid TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (kind, sku, content_hash)
+        )"""
+    )
+
+
+_database = storage.Database("asana_ledger.sqlite3", _create_tables)
+
+
+def content_hash(values):
+    """Hash a row of cell values; NaN-like cells and numbers are normalised through ``str``."""
+    return hashlib.sha256(json.dumps([str(value) for value in values]).encode("utf-8")).hexdigest()
+
+
+def is_recorded(kind, sku, row_hash):
+    with _database.connection() as conn:
+        row = conn.execute(
+            "SELECT 1 FROM entries WHERE kind = ? AND sku = ? AND content_hash = ?", (kind, str(sku), row_hash)
+        ).fetchone()
+    return row is not None
+
+
+def record(kind, sku, row_hash, task_gid):
+    """Remember that ``task_gid`` (the task, or the parent task of a subtask) covers this row."""
+    with _database.write_lock, _database.connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (kind, sku, content_hash, task_gid, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, str(sku), row_hash, str(task_gid), time.time()),
+        )
+
+
+def reconcile(existing_task_gids):
+    """Forget entries whose task no longer exists in Asana, so their rows are sent again.
+
+    Returns the number of entries removed.
+    """
+    existing_task_gids = {str(gid) for gid in existing_task_gids}
+    with _database.write_lock, _database.connection() as conn:
+        recorded = {row["task_gid"] for row in conn.execute("SELECT DISTINCT task_gid FROM entries")}
+        missing = recorded - existing_task_gids
+        removed = 0
+        for gid in missing:
+            removed += conn.execute("DELETE FROM entries WHERE task_gid = ?", (gid,)).rowcount
+    return removed
@@ -0,0 +1,90 @@
+"""Benchmark of the workbook loading used by the Asana step (``main.read_workbook``).
+
+Compares the old pattern (open ``pd.ExcelFile`` for the sheet names, then ``pd.read_excel`` again
+for every sheet, with openpyxl) with a single ``sheet_name=None`` parse, using openpyxl and, when
+python-calamine is installed, the calamine engine.
+
+    python benchmarks/xlsx_read.py --rows 50000 --sheets 1
+"""
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+
+def build_workbook(rows, sheets):
+    # Same columns as the result workbook
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        "ean": rng.integers(8_700_000_000_000, 8_799_999_999_999, rows),
+        "sku": [f"SKU{i:06d}" for i in range(rows)],
+        "id": rng.integers(1, 10_000_000, rows),
+        "rating": rng.integers(1, 4, rows),
+        "Sku description": [f"Product description number {i}" for i in range(rows)],
+        "F1 to Use": [f"F1-{i % 5000:05d}" for i in range(rows)],
+        "Barcode": [str(8_712_345_000_000 + i) for i in range(rows)],
+        "GS1 Brand": rng.choice(["Brand A", "Brand B", "Brand C"], rows),
+    })
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        for sheet in range(sheets):
+            df.to_excel(writer, sheet_name=f"Sheet{sheet + 1}", index=False)
+    return output.getvalue()
+
+
+def per_sheet_openpyxl(data):
+    input_file = BytesIO(data)
+    xls = pd.ExcelFile(input_file)
+    return {sheet: pd.read_excel(input_file, sheet_name=sheet) for sheet in xls.sheet_names}
+
+
+def single_parse(engine):
+    def read(data):
+        return pd.read_excel(BytesIO(data), sheet_name=None, engine=engine)
+    return read
+
+
+def best_of(func, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(data)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--sheets", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = build_workbook(args.rows, args.sheets)
+    print(f"Workbook: {args.rows} rows x {args.sheets} sheet(s), {len(data) / 2 ** 20:.1f} MiB")
+
+    candidates = [
+        ("ExcelFile + read_excel per sheet (openpyxl)", per_sheet_openpyxl),
+        ("single parse, openpyxl", single_parse("openpyxl")),
+    ]
+    try:
+        import python_calamine  # noqa: F401
+        candidates.append(("single parse, calamine", single_parse("calamine")))
+    except ImportError:
+        print("python-calamine is not installed, skipping the calamine engine")
+
+    baseline = reference = None
+    for name, func in candidates:
+        seconds, result = best_of(func, data, args.repeat)
+        if reference is None:
+            baseline, reference = seconds, result
+        else:
+            for sheet, df in reference.items():
+                pd.testing.assert_frame_equal(df, result[sheet], check_dtype=False)
+        print(f"{name:<46} {seconds:8.2f}s  {baseline / seconds:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Background jobs for the BOL pipeline.
+
+Pipelines run on a process-wide worker pool instead of the Streamlit script thread, so a run
+survives the browser tab closing. Job state is kept in a small SQLite table on disk: any
+session can poll a job by its ID, reattach to it, or ask for it to be cancelled. Jobs submitted
+with a run key (a hash of their inputs) are shared: an identical request joins the existing job,
+or reuses a recent result that covered every product.
+"""
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+RESULTS_DIR = os.path.join(storage.DATA_DIR, "results")
+# Each pipeline is mostly waiting on the network, but they share one set of API rate limits
+MAX_WORKERS = int(os.environ.get("BOL_FS_JOB_WORKERS", "2"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="bol-job")
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when its cancellation has been requested."""
+
+
+def _create_tables(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result_path TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            run_key TEXT,
+            checked INTEGER,
+            total INTEGER,
+            data_at REAL
+        )"""
+    )
+    # Tables created before run keys, coverage and data ages existed
+    columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+    for column, column_type in (("run_key", "TEXT"), ("checked", "INTEGER"), ("total", "INTEGER"), ("data_at", "REAL")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_run_key ON jobs (run_key)")
+
+
+_database = storage.Database("jobs.sqlite3", _create_tables)
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    with _database.write_lock, _database.connection() as conn:
+        conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def get(job_id):
+    with _database.connection() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_jobs(limit=10):
+    with _database.connection() as conn:
+        rows = conn.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def latest_result(kinds=("pipeline", "refresh")):
+    """The most recently finished job of ``kinds`` that produced a result file."""
+    with _database.connection() as conn:
+        row = conn.execute(
+            f"""SELECT * FROM jobs WHERE status = ? AND result_path IS NOT NULL
+                AND kind IN ({', '.join('?' * len(kinds))}) ORDER BY updated_at DESC LIMIT 1""",
+            (DONE, *kinds),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def latest(kind):
+    with _database.connection() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT 1", (kind,)).fetchone()
+    return dict(row) if row else None
+
+
+def find_active(kind):
+    with _database.connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE kind = ? AND status IN (?, ?) ORDER BY created_at DESC LIMIT 1",
+            (kind, *ACTIVE_STATUSES),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def cancel(job_id):
+    # The worker notices the flag at its next checkpoint; a queued job is dropped before it starts
+    _update(job_id, cancel_requested=1)
+    logging.info(f"Cancellation requested for job {job_id}.")
+
+
+def result_path(job_id, suffix=".xlsx"):
+    return os.path.join(RESULTS_DIR, f"{job_id}{suffix}")
+
+
+class JobContext:
+    """Handle passed to the job function for progress reporting and cancellation checks."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        # Set by the job function to replace the generic "Finished." status message
+        self.summary = None
+        # Set by the job function to the ``checked`` and ``total`` counts of what it covered
+        self.coverage = None
+        # Set by the job function to when the data behind its result was fetched, if not just now
+        self.data_at = None
+        self._cancel_checked_at = 0.0
+        self._cancelled = False
+
+    def report(self, progress=None, message=None):
+        fields = {}
+        if progress is not None:
+            fields["progress"] = float(progress)
+        if message is not None:
+            fields["message"] = message
+        if fields:
+            _update(self.job_id, **fields)
+
+    def cancelled(self):
+        # Poll the table at most once a second, the crawl calls this for every EAN
+        now = time.monotonic()
+        if not self._cancelled and now - self._cancel_checked_at >= 1:
+            self._cancel_checked_at = now
+            job = get(self.job_id)
+            self._cancelled = bool(job and job["cancel_requested"])
+        return self._cancelled
+
+    def check_cancelled(self):
+        if self.cancelled():
+            raise JobCancelled(self.job_id)
+
+    def result_path(self, suffix=".xlsx"):
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        return result_path(self.job_id, suffix)
+
+
+def _run(job_id, func, args, kwargs):
+    job = JobContext(job_id)
+    if job.cancelled():
+        _update(job_id, status=CANCELLED, message="Cancelled before it started.")
+        return
+    _update(job_id, status=RUNNING, message="Started.")
+    logging.info(f"Job {job_id} started.")
+    try:
+        result_path = func(job, *args, **kwargs)
+    except JobCancelled:
+        logging.warning(f"Job {job_id} cancelled.")
+        _update(job_id, status=CANCELLED, message="Cancelled.")
+    except Exception as e:
+        logging.exception(f"Job {job_id} failed: {e}")
+        _update(job_id, status=FAILED, error=str(e), message="Failed.")
+    else:
+        logging.info(f"Job {job_id} finished.")
+        coverage = job.coverage or {}
+        _update(job_id, status=DONE, progress=1.0, result_path=result_path, message=job.summary or "Finished.",
+                checked=coverage.get("checked"), total=coverage.get("total"), data_at=job.data_at)
+
+
+def _insert(conn, kind, run_key=None):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn.execute(
+        "INSERT INTO jobs (id, kind, status, created_at, updated_at, message, run_key) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (job_id, kind, QUEUED, now, now, "Waiting for a free worker.", run_key),
+    )
+    return job_id
+
+
+def submit(kind, func, *args, **kwargs):
+    """Queue ``func(job, *args, **kwargs)`` on the worker pool and return the new job ID.
+
+    The function returns the path of its result file, or ``None`` if it produced nothing.
+    """
+    with _database.write_lock, _database.connection() as conn:
+        job_id = _insert(conn, kind)
+    _executor.submit(_run, job_id, func, args, kwargs)
+    logging.info(f"Submitted {kind} job {job_id}.")
+    return job_id
+
+
+def submit_or_join(kind, run_key, max_age, func, *args, **kwargs):
+    """Like ``submit``, but reuse a job with the same run key if one is still active or
+    finished less than ``max_age`` seconds ago having checked everything it set out to (a run cut
+    short by its time budget or by failures is not handed to anyone else). Returns ``(job_id, joined)``.
+    """
+    with _database.write_lock, _database.connection() as conn:
+        # Lookup and insert happen under one lock so two sessions submitting together share a job
+        row = conn.execute(
+            """SELECT id FROM jobs
+               WHERE kind = ? AND run_key = ? AND cancel_requested = 0
+                 AND (status IN (?, ?) OR (status = ? AND created_at >= ? AND checked = total))
+               ORDER BY created_at DESC LIMIT 1""",
+            (kind, run_key, *ACTIVE_STATUSES, DONE, time.time() - max_age),
+        ).fetchone()
+        if row:
+            logging.info(f"Joining {kind} job {row['id']} for run key {run_key[:12]}.")
+            return row["id"], True
+        job_id = _insert(conn, kind, run_key)
+    _executor.submit(_run, job_id, func, args, kwargs)
+    logging.info(f"Submitted {kind} job {job_id} for run key {run_key[:12]}.")
+    return job_id, False
+
+
+def fail_interrupted_jobs():
+    """Mark every job still queued or running as failed.
+
+    Jobs only live as long as the process that runs them, so when a server starts anything still
+    active was cut off. Call it once per server process, never from a process that only reads.
+    """
+    with _database.write_lock, _database.connection() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = ?, message = ?, updated_at = ? WHERE status IN (?, ?)",
+            (FAILED, "Interrupted by a server restart.", time.time(), *ACTIVE_STATUSES),
+        )
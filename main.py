@@ -1,6 +1,11 @@
+import argparse
 import base64
 import csv
+import hashlib
 import logging
+import os
+import re
+import threading
 import time
 from io import BytesIO, StringIO
 import json
@@ -8,6 +13,23 @@ import pandas as pd
 import requests
 import streamlit as st
 
+try:
+    # Native (Rust) XLSX reader, several times faster than openpyxl
+    import python_calamine  # noqa: F401
+    XLSX_ENGINE = "calamine"
+except ImportError:
+    XLSX_ENGINE = "openpyxl"
+
+import asana_ledger
+import jobs
+import profiling
+import ratings_history
+import resilience
+import scheduling
+import stage_cache
+import storage
+import transport
+
 # Set up basic logging configuration
 logging.basicConfig(
     level=logging.DEBUG,  # Set logging level to DEBUG, INFO, WARNING, ERROR
@@ -18,70 +40,499 @@ logging.basicConfig(
     ]
 )
 
+@st.cache_resource(show_spinner=False)
+def load_settings():
+    # Secrets only change on a redeploy, so read them once per server process instead of on every rerun
+    keys = ["MARKETPLACE_BASE_URL", "BOL_CLIENT_ID", "BOL_CLIENT_SECRET", "BOL_TOKEN_URL", "ASANA_TOKEN"]
+    settings = {key: st.secrets[key] for key in keys}
+    # Optional extra API clients for the same retailer, as [[BOL_CREDENTIALS]] tables with client_id and client_secret
+    settings["BOL_CREDENTIALS"] = [dict(credential) for credential in st.secrets.get("BOL_CREDENTIALS", [])]
+    return settings
+
 # Marketplace API setup
-MARKETPLACE_BASE_URL= st.secrets["MARKETPLACE_BASE_URL"]
-BOL_CLIENT_ID = st.secrets["BOL_CLIENT_ID"]
-BOL_CLIENT_SECRET= st.secrets["BOL_CLIENT_SECRET"]
-BOL_TOKEN_URL= st.secrets["BOL_TOKEN_URL"]
-ASANA_TOKEN = st.secrets["ASANA_TOKEN"]
+SETTINGS = load_settings()
+MARKETPLACE_BASE_URL= SETTINGS["MARKETPLACE_BASE_URL"]
+BOL_CLIENT_ID = SETTINGS["BOL_CLIENT_ID"]
+BOL_CLIENT_SECRET= SETTINGS["BOL_CLIENT_SECRET"]
+BOL_TOKEN_URL= SETTINGS["BOL_TOKEN_URL"]
+ASANA_TOKEN = SETTINGS["ASANA_TOKEN"]
+BOL_CREDENTIALS = SETTINGS["BOL_CREDENTIALS"]
 marketplace_name = "bol"
 
+# Reference data sources
+LISTING_URL = 'https://files.channable.com/n8wWOX9ZCS6umlM-vKHUIw==.csv'
+SKU_DESCRIPTION_SHEET_URL = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vS_mN7-KwnH2aN-afhBMbM_1IlBylxwgJByEkQU5M3HJQuSDx8-pk3HwaJ5TOLgNeD0SGcdgHikloFK/pub?gid=788370787&single=true&output=csv'
+F1_SHEET_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxBqpSTMwezeOji3KXDlrp3855sQHFuYxmKsCIDwILg4iHMEx2BBmp87nwEgI__4g3rM6H65rIp0sF/pub?gid=0&single=true&output=csv"
+# Only the cells the lookups read are exported: the SKU columns of the description sheet (found
+# through its header on row 3) and the 15 columns the F1 sheet is searched in, plus column A so
+# both exports parse exactly like the full sheet
+SKU_DESCRIPTION_HEADER_ROW = 3
+SKU_DESCRIPTION_COLUMNS = ['Sku code', 'Sku description']
+F1_SHEET_RANGE = "A1:P"
+# How long a downloaded reference sheet is trusted before it is fetched again (seconds)
+REFERENCE_DATA_TTL = 15 * 60
+LISTING_TTL = 15 * 60
+# Parsed versions of each reference index kept in memory
+INDEX_CACHE_ENTRIES = 4
+# Products whose worst rating with a count above zero is at or below this are flagged
+RATING_THRESHOLD = 3
+# One breaker for the ratings endpoint, shared by every crawl running in this process
+RATINGS_BREAKER_SETTINGS = {"failure_threshold": 5, "reset_timeout": 30.0}
+# How long a request waits for an open breaker before its EAN is handed to the retry queue (seconds)
+RATINGS_BREAKER_MAX_WAIT = 10 * 60
+# How often a worker waiting on an open breaker checks whether its run was cancelled (seconds)
+RATINGS_BREAKER_POLL = 1.0
+# Connect and read timeouts for a single ratings request (seconds)
+RATINGS_TIMEOUT = (5, 20)
+# A request still running past this percentile of recent latencies gets a duplicate sent ...
+RATINGS_HEDGE_PERCENTILE = 95
+# ... as long as duplicates stay under this share of all requests (0 turns hedging off)
+RATINGS_HEDGE_RATIO = 0.05
+# Ratings requests per second allowed for each bol.com API credential
+RATINGS_RATE_PER_CREDENTIAL = 1.0
+# EANs in a row a credential may fail before it is taken out of the crawl
+CREDENTIAL_MAX_FAILURES = 5
+# Extra passes over the EANs whose ratings could not be fetched
+RATINGS_RETRY_PASSES = 2
+# Stored ratings younger than this are reused by a background refresh instead of fetched again (seconds)
+RATINGS_TTL = 24 * 60 * 60
+# The latest results are served straight away, and revalidated in the background once older than this
+RESULTS_TTL = 6 * 60 * 60
+# How long to wait after a failed background refresh before trying another one (seconds)
+REFRESH_RETRY_AFTER = 15 * 60
+# A finished run with identical inputs is served again instead of recomputed for this long (seconds)
+RUN_REUSE_TTL = 24 * 60 * 60
+
+PROFILES_DIR = os.path.join(storage.DATA_DIR, "profiles")
+# Last downloaded listing feed, so a dry run can work without calling Channable
+LISTING_SNAPSHOT = os.path.join(storage.DATA_DIR, "listing.tsv")
+
+def parse_cli_args(argv=None):
+    # Streamlit passes everything after "--" on to the script: streamlit run main.py -- --profile
+    parser = argparse.ArgumentParser(description="BOL F1s processor")
+    parser.add_argument("--profile", action="store_true", help="profile the pipeline stages of every run by default")
+    parser.add_argument("--profile-mode", choices=profiling.MODES, default=profiling.DETERMINISTIC,
+                        help="deterministic (cProfile) or sampling profiler")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the estimated API calls and duration of the next run and exit (python main.py --dry-run)")
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+CLI_ARGS = parse_cli_args()
+
 # Initialize session state for keeping track of file paths
 if "output_file" not in st.session_state:
     st.session_state.output_file = None
+# Background pipeline run this session is attached to, and the run whose result is loaded
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
+if "loaded_job_id" not in st.session_state:
+    st.session_state.loaded_job_id = None
+
+@st.cache_resource(show_spinner=False)
+def http_session(service):
+    """One pooled HTTP client per upstream service, shared by every rerun and session."""
+    session = requests.Session()
+    # Live by default, BOL_FS_TRANSPORT switches every session to recording or replaying a cassette
+    mode = transport.mount(session)
+    logging.info(f"Created HTTP session for {service} ({mode}).")
+    return session
+
+@st.cache_resource(show_spinner=False)
+def recover_jobs():
+    # Once per server process, a dry run from the command line must not touch the server's jobs
+    jobs.fail_interrupted_jobs()
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+@st.cache_data(ttl=LISTING_TTL, show_spinner=False)
+def fetch_listing():
+    logging.info("Downloading listing feed.")
+    response = http_session("channable").get(LISTING_URL)
+    response.raise_for_status()
+    os.makedirs(storage.DATA_DIR, exist_ok=True)
+    # Kept byte for byte, the dry run hashes it to find the stored crawl of this listing
+    with open(LISTING_SNAPSHOT + ".tmp", "w", encoding="utf-8", newline="") as f:
+        f.write(response.text)
+    os.replace(LISTING_SNAPSHOT + ".tmp", LISTING_SNAPSHOT)
+    return response.text
+
+@st.cache_data(ttl=REFERENCE_DATA_TTL, show_spinner=False)
+def fetch_sheet_csv(url, cell_range=None):
+    """CSV export of a published sheet, limited to ``cell_range`` (A1 notation) when given. The
+    session asks for a gzip-compressed response, which Google serves for these exports."""
+    logging.info(f"Downloading reference sheet {url}" + (f" (range {cell_range})" if cell_range else ""))
+    response = http_session("google").get(url, params={"range": cell_range} if cell_range else None)
+    response.raise_for_status()
+    return response.text
+
+def column_letter(position):
+    """Spreadsheet letter of a 0-based column position: 0 -> A, 25 -> Z, 26 -> AA."""
+    letters = ""
+    position += 1
+    while position:
+        position, remainder = divmod(position - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+def sheet_header(csv_text, header_row):
+    return list(pd.read_csv(StringIO(csv_text), header=header_row - 1, nrows=0).columns)
+
+def fetch_sheet_columns(url, header_row=1, columns=None, cell_range=None):
+    """Export only the columns that are read from a published sheet, so the download and parse stay
+    small as the sheet grows. ``columns`` are looked up by name on ``header_row`` and exported as
+    the smallest block of columns holding all of them; ``cell_range`` gives the block directly.
+    Falls back to the full export when the range export fails or lacks a column."""
+    try:
+        if cell_range is None:
+            header = sheet_header(fetch_sheet_csv(url, f"A1:ZZ{header_row}"), header_row)
+            positions = [header.index(column) for column in columns]
+            cell_range = f"{column_letter(min(positions))}1:{column_letter(max(positions))}"
+        csv_text = fetch_sheet_csv(url, cell_range)
+        missing = [column for column in columns or [] if column not in sheet_header(csv_text, header_row)]
+        if missing:
+            raise ValueError(f"{missing} not in the range export")
+        return csv_text
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Range export of {url} failed ({e}), downloading the full sheet instead.")
+        return fetch_sheet_csv(url)
+
+# The parsed indexes are keyed by the content hash of the download (the leading underscore keeps
+# the raw text out of the cache key), so an expired sheet that comes back unchanged is not parsed again.
+# Only the last few versions are kept, so a sheet that changes all day does not pile up parsed copies.
+@st.cache_data(max_entries=INDEX_CACHE_ENTRIES, show_spinner=False)
+def sku_description_index(sheet_hash, _csv_text):
+    logging.info(f"Parsing SKU description sheet {sheet_hash[:12]}")
+    df_csv = pd.read_csv(StringIO(_csv_text), header=2)
+    df_csv['Sku code'] = df_csv['Sku code'].astype(str)
+    # Extract numeric-only SKU values for fallback matching
+    df_csv['Numeric Sku'] = df_csv['Sku code'].str.extract(r'(\d+)')  # Extract only numbers
+    sku_desc_dict = df_csv.dropna(subset=['Numeric Sku']).set_index('Numeric Sku')['Sku description'].to_dict()
+    exact_desc_dict = df_csv.drop_duplicates('Sku code').set_index('Sku code')['Sku description'].to_dict()
+    return sku_desc_dict, exact_desc_dict
+
+@st.cache_data(max_entries=INDEX_CACHE_ENTRIES, show_spinner=False)
+def f1_index(sheet_hash, _csv_text):
+    logging.info(f"Indexing F1 sheet {sheet_hash[:12]}")
+    df_csv = pd.read_csv(StringIO(_csv_text))
+    f1_columns = df_csv.iloc[:, 1:16]
+    index = []
+    for cells, values in zip(f1_columns.astype(str).itertuples(index=False, name=None),
+                             f1_columns.itertuples(index=False, name=None)):
+        # The F1 to use is the last non-empty value on the row
+        non_empty = [value for value in values if pd.notna(value)]
+        index.append((cells, non_empty[-1] if non_empty else None))
+    return index
+
+@st.cache_data(max_entries=INDEX_CACHE_ENTRIES, show_spinner=False)
+def barcode_index(file_hash, _csv_bytes):
+    logging.info(f"Indexing barcode file {file_hash[:12]}")
+    df_barcodes = pd.read_csv(BytesIO(_csv_bytes))
+    index = {}
+    for sku, number, brand in zip(df_barcodes['SKU'], df_barcodes['Number'], df_barcodes['Main Brand']):
+        # Keep the first row for each SKU, like the original row filter did
+        if pd.notna(sku) and sku not in index:
+            index[sku] = (str(number).replace('=', '').replace('"', ''), brand)
+    return index
+
+def load_sku_descriptions(csv_text):
+    return sku_description_index(content_hash(csv_text), csv_text)
+
+def load_f1_index(csv_text):
+    return f1_index(content_hash(csv_text), csv_text)
+
+def load_barcode_index(barcode_data):
+    return barcode_index(content_hash(barcode_data), barcode_data)
+
+def clear_reference_caches():
+    fetch_listing.clear()
+    fetch_sheet_csv.clear()
+    sku_description_index.clear()
+    f1_index.clear()
+    barcode_index.clear()
+    logging.info("Reference data caches cleared.")
+
+def find_f1_to_use(sku, index):
+    for cells, f1_to_use in index:
+        if any(sku in cell for cell in cells):
+            return f1_to_use
+    return None
+
+def describe_sku(sku, descriptions):
+    sku_desc_dict, exact_desc_dict = descriptions
+    description = exact_desc_dict.get(sku)
+    if pd.isna(description):
+        # Fall back to matching on the numeric part of the SKU
+        numeric_sku = re.search(r'\d+', sku)
+        description = sku_desc_dict.get(numeric_sku.group()) if numeric_sku else None
+    return description
+
+def find_barcode(f1, index):
+    found = index.get(f1) if pd.notna(f1) else None
+    return found or (None, None)
+
+def normalize_cell(value):
+    # Numeric cells of columns with gaps are parsed as floats, 12.0 is looked up and written as 12
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def lookup_description(row, index):
+    return [describe_sku(row["sku"], index)]
+
+def lookup_f1(row, index):
+    return [normalize_cell(find_f1_to_use(row["sku"], index))]
+
+def lookup_barcode(row, index):
+    return list(find_barcode(row["F1 to Use"], index))
+
+RATING_COLUMNS = ["ean", "sku", "id", "rating"]
+# The stages after the ratings crawl, in dependency order: name, the run input it looks up in, the
+# stages whose columns it reads, the columns it adds and the lookup for one row
+LOOKUP_STAGES = [
+    ("description", "sku_sheet", ["ratings"], ["Sku description"], lookup_description),
+    ("f1", "f1_sheet", ["ratings"], ["F1 to Use"], lookup_f1),
+    ("barcodes", "barcodes", ["f1"], ["Barcode", "GS1 Brand"], lookup_barcode),
+]
+ENRICHED_COLUMNS = RATING_COLUMNS + [column for *_, columns, _ in LOOKUP_STAGES for column in columns]
+
+def load_lookup_indexes(inputs):
+    return {
+        "description": load_sku_descriptions(inputs["sku_sheet"]),
+        "f1": load_f1_index(inputs["f1_sheet"]),
+        "barcodes": load_barcode_index(inputs["barcodes"]),
+    }
+
+def enrich_rating_row(row, indexes):
+    """Run one ``[ean, sku, id, rating]`` crawl result through the description, F1 and barcode lookups."""
+    enriched = dict(zip(RATING_COLUMNS, row))
+    enriched["sku"] = str(normalize_cell(enriched["sku"]))
+    for stage, _, _, columns, lookup in LOOKUP_STAGES:
+        enriched.update(zip(columns, lookup(enriched, indexes[stage])))
+    return [enriched[column] for column in ENRICHED_COLUMNS]
+
+def read_workbook(input_file):
+    """Parse every sheet of a workbook in one pass, returning ``{sheet name: DataFrame}``."""
+    if hasattr(input_file, "seek"):
+        input_file.seek(0)
+    return pd.read_excel(input_file, sheet_name=None, engine=XLSX_ENGINE)
+
+def collect_run_inputs(barcode_data, rating_threshold=RATING_THRESHOLD, time_budget=None, max_rating_age=None):
+    # Snapshot everything a run depends on, the job works from this snapshot and it is what the run key hashes
+    return {
+        "listing": fetch_listing(),
+        "sku_sheet": fetch_sheet_columns(SKU_DESCRIPTION_SHEET_URL, SKU_DESCRIPTION_HEADER_ROW, SKU_DESCRIPTION_COLUMNS),
+        "f1_sheet": fetch_sheet_columns(F1_SHEET_URL, cell_range=F1_SHEET_RANGE),
+        "barcodes": barcode_data,
+        "rating_threshold": rating_threshold,
+        "time_budget": time_budget,
+        "max_rating_age": max_rating_age,
+    }
+
+def run_key(inputs):
+    parts = [content_hash(inputs[name]) for name in ("listing", "sku_sheet", "f1_sheet", "barcodes")]
+    parts.append(f"threshold={inputs['rating_threshold']}")
+    # A time-boxed run only covers part of the listing, so it must not be served for a full one
+    parts.append(f"budget={inputs['time_budget']}")
+    parts.append(f"max_rating_age={inputs['max_rating_age']}")
+    return content_hash("|".join(parts))
 
-def analyze_listing():
+@profiling.profiled
+def analyze_listing(listing_text):
     try:
-        csv_file = 'https://files.channable.com/n8wWOX9ZCS6umlM-vKHUIw==.csv'
-        df = pd.read_csv(csv_file, delimiter='\t')
+        df = pd.read_csv(StringIO(listing_text), delimiter='\t')
         logging.info(f"Successfully read CSV file {len(df)} rows found.")
         return df
-    except Exception as e:
-        st.error(f"Error reading CSV file  {e}")
-        raise
     except Exception as e:
         logging.error(f"An unexpected error occurred during the Processing of Listing File: {e}")
-        st.error("An unexpected error occurred during the Processing of Listing File")
+        raise
 
-def update_excel_with_rating(listing_df, access_token):
-    filtered_data = []
-    processed_eans = set()  # to track unique EANs processed
-    #count =0
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Accept': 'application/vnd.retailer.v9+json'
-    }
-    logging.info("Starting to update listing file with the ratings.")
+def unique_listings(listing_df):
+    """``{ean: row}`` for the listed products, in feed order, up to the first repeated EAN."""
+    listings = {}
     for index, row in listing_df.iterrows():
         # if count >= 500:  # Stop after processing 100 products (for testing )
         #     break
-        ean = int(row['EAN'])  # Make sure 'EAN' matches the exact column name in your local CSV
+        ean = pd.to_numeric(row['EAN'], errors='coerce')  # Make sure 'EAN' matches the exact column name in your local CSV
+        if pd.isna(ean):
+            logging.warning(f"Skipping listing row {index} without a valid EAN: {row['EAN']!r}")
+            continue
+        ean = int(ean)
         # Check for repeating EANs
-        if ean in processed_eans:
+        if ean in listings:
             logging.warning(f"EAN {ean} already processed earlier. Repetition detected. Stopping further processing.")
             break
-        processed_eans.add(ean)
-        ratings_response, new_token = get_product_ratings(ean, headers)
-        # If token was refreshed, update headers and token for future requests
-        if new_token:
-            access_token = new_token
-            headers['Authorization'] = f'Bearer {access_token}'
+        listings[ean] = row
+    return listings
+
+@profiling.profiled
+def update_excel_with_rating(listing_df, credentials, rating_threshold=RATING_THRESHOLD, time_budget=None, job=None,
+                             max_rating_age=None, on_row=None):
+    """Crawl the ratings of every listed EAN and return ``(filtered_data, coverage)``.
+
+    Every ``BolCredential`` gets its own worker thread, token and rate limiter, and the EANs are
+    spread over them with work stealing, so throughput grows with the number of credentials.
+    With a ``time_budget`` (seconds) no new EAN is started once it is spent, and the rows found so
+    far are returned. ``coverage`` says how many of the unique EANs were actually checked, how many
+    of them were fetched from the API and, as ``ratings_at``, when the oldest rating was checked.
+    With ``max_rating_age`` (seconds) EANs checked more recently than that are answered from the
+    rating history instead of the API. ``on_row`` is called with every flagged row as soon as it is
+    found, so later stages can process it while the crawl goes on.
+    """
+    deadline = time.monotonic() + time_budget if time_budget else None
+    filtered_data = []
+    processed_eans = set()  # to track unique EANs processed
+    results_lock = threading.Lock()
+    #count =0
+    logging.info("Starting to update listing file with the ratings.")
+    listings = unique_listings(listing_df)
+    # Visit new and likely low-rated products first so the useful findings arrive early in the run
+    pending = ratings_history.prioritize(list(listings), rating_threshold)
+    total = len(pending)
+    stop = threading.Event()
+    out_of_time = threading.Event()
+    errors = []
+
+    def record_result(ean, ratings_response, from_history=False):
+        row = listings[ean]
         ratings = ratings_response.get("ratings", []) if ratings_response else []
+        if not from_history:
+            # EANs bol.com answered without ratings (404 or 400) are recorded as checked with none, so
+            # they are not crawled first as never seen on every run
+            ratings_history.record(ean, ratings)
+
+        # Filter ratings at or below the threshold (1, 2 or 3 by default) with count > 0
+        valid_ratings = [r['rating'] for r in ratings if r['rating'] <= rating_threshold and r['count'] > 0]
+        with results_lock:
+            processed_eans.add(ean)
+            if valid_ratings:
+                min_rating = min(valid_ratings)
+                filtered_data.append([ean, row['sku'], row['id'], min_rating])
+                if on_row:
+                    on_row(filtered_data[-1])
+            logging.info(f"Processed EAN: {ean} | SKU: {row['sku']}")
+            if job and len(processed_eans) % 25 == 0:
+                job.report(len(processed_eans) / total, f"Checked ratings for {len(processed_eans)} of {total} listings.")
+
+    def crawl_worker(worker, credential, queues, retry_queue):
+        try:
+            while not stop.is_set():
+                if job and job.cancelled():
+                    stop.set()
+                    return
+                if deadline and time.monotonic() >= deadline:
+                    logging.warning(f"Time budget of {time_budget} seconds spent after {len(processed_eans)} of {total} EANs.")
+                    out_of_time.set()
+                    stop.set()
+                    return
+                ean = queues.take(worker)
+                if ean is None:
+                    return
+                try:
+                    ratings_response, new_token = get_product_ratings(ean, credential.headers, client_id=credential.client_id,
+                                                                      client_secret=credential.client_secret, deadline=deadline,
+                                                                      cancelled=job.cancelled if job else None,
+                                                                      limiter=credential.limiter)
+                except CredentialRejected as e:
+                    logging.warning(f"Credential {credential.name} rejected for EAN {ean}, queued for retry: {e}")
+                    retry_queue.append(ean)
+                    credential.failures += 1
+                    with results_lock:
+                        # The last credential stays, a crawl without any would just end
+                        others = [other for other in credentials if other is not credential and not other.retired]
+                        if credential.failures >= CREDENTIAL_MAX_FAILURES and others:
+                            # Its remaining EANs are stolen by the workers of the other credentials
+                            logging.error(f"Credential {credential.name} rejected {credential.failures} EANs in a row, taking it out of the crawl.")
+                            credential.retired = True
+                            return
+                    continue
+                except RatingsUnavailable as e:
+                    # EANs whose ratings could not be fetched go to a retry queue instead of being dropped. Breaker
+                    # timeouts and server errors hit every credential alike, so they do not count against this one.
+                    logging.warning(f"Ratings for EAN {ean} unavailable, queued for retry: {e}")
+                    retry_queue.append(ean)
+                    continue
+                credential.failures = 0
+                # If token was refreshed, update headers and token for future requests
+                if new_token:
+                    credential.headers['Authorization'] = f'Bearer {new_token}'
+                record_result(ean, ratings_response)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    ratings_at = None
+    if max_rating_age:
+        # Only revalidate the EANs whose stored ratings are past their TTL
+        history = ratings_history.load(pending)
+        fresh_after = time.time() - max_rating_age
+        fresh = [ean for ean in pending if ean in history and history[ean]["checked_at"] >= fresh_after]
+        for ean in fresh:
+            record_result(ean, history[ean], from_history=True)
+        ratings_at = min((history[ean]["checked_at"] for ean in fresh), default=None)
+        fresh = set(fresh)
+        pending = [ean for ean in pending if ean not in fresh]
+        logging.info(f"Reusing stored ratings for {len(fresh)} EANs, revalidating {len(pending)}.")
+    reused = len(processed_eans)
+    # Request count and latency of this crawl are kept for the dry-run estimate
+    latency = resilience.latency_tracker("bol_ratings")
+    requests_before = latency.count
+    crawl_started = time.monotonic()
+    crawl_started_at = time.time()
+
+    for attempt in range(RATINGS_RETRY_PASSES + 1):
+        active = [credential for credential in credentials if not credential.retired]
+        if not active:
+            logging.error("Every bol.com credential has been taken out of the crawl.")
+            break
+        if attempt:
+            logging.info(f"Retrying {len(pending)} EANs whose ratings could not be fetched.")
+        queues = scheduling.WorkStealingQueues(pending, len(active))
+        retry_queue = []
+        workers = [threading.Thread(target=profiling.bind(crawl_worker), args=(worker, credential, queues, retry_queue),
+                                    name=f"bol-ratings-{worker}", daemon=True)
+                   for worker, credential in enumerate(active)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if job:
+            job.check_cancelled()
+        if errors:
+            raise errors[0]
+        if out_of_time.is_set():
+            pending = retry_queue
+            break
+        # Anything still queued was left by credentials that were taken out of the crawl
+        pending = retry_queue + queues.drain()
+        if not pending:
+            break
+    if pending:
+        logging.error(f"Ratings for {len(pending)} EANs could not be fetched: {pending}")
+    fetched = len(processed_eans) - reused
+    if fetched:
+        ratings_history.record_crawl(fetched, latency.count - requests_before, len(credentials),
+                                     time.monotonic() - crawl_started, latency.mean())
+        ratings_at = min(ratings_at or crawl_started_at, crawl_started_at)
+    coverage = {
+        "checked": len(processed_eans),
+        "total": total,
+        "failed": len(pending),
+        "percent": 100.0 * len(processed_eans) / total if total else 100.0,
+        "fetched": fetched,
+        "ratings_at": ratings_at,
+    }
+    logging.info(f"Checked {coverage['checked']} of {total} EANs ({coverage['percent']:.1f}%).")
+    return filtered_data, coverage
 
-        # Filter ratings of 1, 2, or 3 with count > 0
-        valid_ratings = [r['rating'] for r in ratings if r['rating'] in [1, 2, 3] and r['count'] > 0]
-
-        if valid_ratings:
-            min_rating = min(valid_ratings)
-            filtered_data.append([ean, row['sku'], row['id'], min_rating])
-        logging.info(f"Processed EAN: {ean} | SKU: {row['sku']}")
-        time.sleep(1)
-    return filtered_data
-
-def write_filtered_ratings(data):
+@profiling.profiled
+def write_filtered_ratings(data, columns=("ean", "sku", "id", "rating")):
     logging.info(f"Writing filtered ratings to filtered_ratings.csv ...")
     try:
-        df = pd.DataFrame(data, columns=["ean", "sku", "id", "rating"])
+        df = pd.DataFrame(data, columns=list(columns))
         # Create a BytesIO object to save the Excel file
         output = BytesIO()
         # Write the DataFrame to an Excel file in the BytesIO object
@@ -91,189 +542,15 @@ def write_filtered_ratings(data):
         # Seek to the beginning of the BytesIO object
         output.seek(0)
         logging.info("Filtered ratings written to CSV successfully.")
-        st.session_state.output_file = output
-        logging.info("Filtered ratings written to CSV successfully.")
+        return output
     except Exception as e:
-        st.error(f"Error writing filtered ratings to CSV: {e}")
-
-
-def update_excel_with_sku_description():
-    try:
-        logging.info("Starting to update filtered_ratings.csv with SKU description.")
-        print("Starting to update filtered_ratings.csv with SKU description.")
-
-        # Load the Excel file from session state
-        input_file = st.session_state.output_file
-        csv_file = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vS_mN7-KwnH2aN-afhBMbM_1IlBylxwgJByEkQU5M3HJQuSDx8-pk3HwaJ5TOLgNeD0SGcdgHikloFK/pub?gid=788370787&single=true&output=csv'
-
-        # Read the CSV file into a DataFrame
-        df_csv = pd.read_csv(csv_file, header=2)
-        df_csv['Sku code'] = df_csv['Sku code'].astype(str)
-
-        # Read the original filtered_ratings.csv into a DataFrame
-        df_excel = pd.read_excel(input_file)
-        df_excel['sku'] = df_excel['sku'].astype(str)
-
-        # Merge based on 'sku' and 'Sku code'
-        merged_df = pd.merge(df_excel, df_csv[['Sku code', 'Sku description']], left_on='sku',
-                             right_on='Sku code', how='left')
-
-        # Extract numeric-only SKU values for fallback matching
-        df_csv['Numeric Sku'] = df_csv['Sku code'].str.extract(r'(\d+)')  # Extract only numbers
-        sku_desc_dict = df_csv.dropna(subset=['Numeric Sku']).set_index('Numeric Sku')['Sku description'].to_dict()
-
-        # Fill missing descriptions by checking numeric SKU
-        merged_df['Numeric Sku'] = merged_df['sku'].str.extract(r'(\d+)')
-        merged_df['Sku description'].fillna(merged_df['Numeric Sku'].map(sku_desc_dict), inplace=True)
-
-        # Drop redundant columns
-        merged_df.drop(columns=['Sku code', 'Numeric Sku'], inplace=True, errors='ignore')
-
-        # Save the merged DataFrame as an Excel file
-        # Create a BytesIO object to store the CSV data
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            merged_df.to_excel(writer, sheet_name="Sheet1",index=False)
-        logging.info("Filtered ratings written to CSV successfully.")
-
-        output.seek(0)
-        # Store the updated file in session state
-        st.session_state.output_file = output
-        logging.info("Successfully updated filtered_ratings file with SKU description information. Saved as filtered_ratings - Desc Added.xlsx")
-
-        # Add a download button for the updated Excel file
-        # st.download_button(
-        #     label="Download Updated Excel File",
-        #     data=output,
-        #     file_name="filtered_ratings_Desc_Added.xlsx",
-        #     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        # )
-
-    except Exception as e:
-        logging.error(f"An error occurred while updating the Excel file with SKU description: {e}")
-        st.error("An error occurred while updating the Excel file with SKU description")
-
-
-def update_excel_with_f1_to_use():
-    try:
-        logging.info("Starting to update F1s - Desc Added.xlsx with F1 to Use.")
-        print("Starting to update F1s - Desc Added.xlsx with F1 to Use.")
-
-        # Load the existing Excel file from session state
-        input_file = st.session_state.output_file
-
-        # Fetch the CSV file from the URL
-        url = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRxBqpSTMwezeOji3KXDlrp3855sQHFuYxmKsCIDwILg4iHMEx2BBmp87nwEgI__4g3rM6H65rIp0sF/pub?gid=0&single=true&output=csv"
-        response = requests.get(url)
-        csv_data = StringIO(response.text)
-        df_csv = pd.read_csv(csv_data)
-        # Store dataframes temporarily
-        df_dict = {}
-
-        df_excel = pd.read_excel(input_file)
-        df_excel['sku'] = df_excel['sku'].astype(str)
-
-        f1_to_use_values = []
-        for sku in df_excel['sku']:
-            found_row = df_csv.iloc[:, 1:16].apply(
-                lambda row: row.astype(str).str.contains(str(sku), na=False).any(), axis=1)
-
-            matching_rows = df_csv[found_row]
-            if not matching_rows.empty:
-                last_non_empty_value = matching_rows.iloc[0, 1:16].dropna().iloc[-1]
-                f1_to_use_values.append(last_non_empty_value)
-            else:
-                f1_to_use_values.append(None)
-
-        df_excel['F1 to Use'] = f1_to_use_values
-        df_dict['Sheet1'] = df_excel
-        # Write the updated data back to a BytesIO object
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            logging.info(f"Writing updated data to sheet.")
-            df_excel.to_excel(writer, sheet_name='Sheet1', index=False)
-
-        logging.info(f"Successfully updated Excel file with F1 to Use information.")
-        output.seek(0)  # Reset the pointer of the BytesIO object
-        st.session_state.output_file = output
-
-        # Add a download button for the updated Excel file
-        # st.download_button(
-        #     label="Download Updated f1 to use",
-        #     data=output,
-        #     file_name="f1_to_use.xlsx",
-        #     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        # )
-    except Exception as e:
-        st.error(f"An error occurred while updating the Excel file with F1 to Use: {e}")
-
-
-def update_excel_with_barcodes(uploaded_barcodes):
-    try:
-        logging.info("Updating filtered_ratings_with_desc_and_F1_to_use.xlsx with Barcodes.")
-        print("Updating filtered_ratings_with_desc_and_F1_to_use.xlsx with Barcodes.")
-
-        input_file = st.session_state.output_file
-        df_barcodes = pd.read_csv(uploaded_barcodes)
-
-        xls = pd.ExcelFile(input_file)
-        sheet_names = xls.sheet_names
-
-        df_dict = {}
-        for sheet in sheet_names:
-            logging.info(f"Processing sheet: {sheet}")
-            df_excel = pd.read_excel(input_file, sheet_name=sheet)
-
-            if 'F1 to Use' in df_excel.columns:
-                barcode_values = []
-                gs1_brand_values = []
-
-                for f1 in df_excel['F1 to Use']:
-                    found_row = df_barcodes[df_barcodes['SKU'] == f1]
-                    if not found_row.empty:
-                        number_value = str(found_row['Number'].iloc[0]).replace('=', '').replace('"', '')
-                        barcode_values.append(number_value)
-
-                        gs1_brand_value = found_row['Main Brand'].iloc[0]
-                        gs1_brand_values.append(gs1_brand_value)
-                    else:
-                        barcode_values.append(None)
-                        gs1_brand_values.append(None)
-
-                df_excel['Barcode'] = barcode_values
-                df_excel['GS1 Brand'] = gs1_brand_values
-                df_dict[sheet] = df_excel
-            else:
-                logging.warning(f"'F1 to Use' column not found in sheet {sheet}. Skipping this sheet.")
-
-        del xls
-
-        # Write the updated data back to a BytesIO object
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            for sheet, df in df_dict.items():
-                logging.info(f"Writing updated data to sheet {sheet}.")
-                df.to_excel(writer, sheet_name=sheet, index=False)
-
-        logging.info(f"Successfully updated {output} with Barcodes.")
-        # Store the output file path in session state so it can be downloaded later
-        output.seek(0)  # Reset the pointer of the BytesIO object
-        st.session_state.output_file = output
-        # Add a download button for the updated Excel file
-        # st.download_button(
-        #     label="barcode",
-        #     data=output,
-        #     file_name="barcode_file.xlsx",
-        #     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        # )
+        logging.error(f"Error writing filtered ratings to CSV: {e}")
+        raise
 
-    except Exception as e:
-        logging.error(f"An error occurred while updating the Excel file with Barcodes: {e}")
-        st.error("An error occurred while updating the Excel file with Barcodes")
 
-def get_access_token():
+def get_access_token(client_id=BOL_CLIENT_ID, client_secret=BOL_CLIENT_SECRET):
     logging.info("Fetching access token...")
-    credentials = f"{BOL_CLIENT_ID}:{BOL_CLIENT_SECRET}"
+    credentials = f"{client_id}:{client_secret}"
     encoded_credentials = base64.b64encode(credentials.encode("utf-8")).decode("utf-8")
     headers = {
         "Authorization": f"Basic {encoded_credentials}",
@@ -281,7 +558,7 @@ def get_access_token():
     }
     try:
         # Make the request to get access token
-        response = requests.post(BOL_TOKEN_URL, headers=headers)
+        response = http_session("bol").post(BOL_TOKEN_URL, headers=headers)
 
         # Check if request was successful
         if response.status_code == 200:
@@ -293,43 +570,170 @@ def get_access_token():
             message = f"Error fetching access token: {response.status_code} - {response.text}"
             return None
     except Exception as e:
-        st.error(f"Exception occurred while fetching access token: {str(e)}")
+        logging.error(f"Exception occurred while fetching access token: {str(e)}")
         return None
 
-def get_product_ratings(ean, headers, max_retries=3):
+class BolCredential:
+    """One bol.com API client used by the ratings crawl, with its own token and rate limiter."""
+
+    def __init__(self, client_id, client_secret):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.name = client_id[:8]
+        self.headers = {'Accept': 'application/vnd.retailer.v9+json'}
+        # Shared with every other crawl using the same client, the rate limit is per client
+        self.limiter = resilience.rate_limiter(f"bol_ratings:{client_id}", RATINGS_RATE_PER_CREDENTIAL)
+        self.failures = 0
+        self.retired = False
+
+    def refresh_token(self):
+        access_token = get_access_token(self.client_id, self.client_secret)
+        if access_token:
+            self.headers['Authorization'] = f'Bearer {access_token}'
+        return access_token
+
+def bol_credentials():
+    credentials = [(BOL_CLIENT_ID, BOL_CLIENT_SECRET)]
+    for credential in BOL_CREDENTIALS:
+        if (credential["client_id"], credential["client_secret"]) not in credentials:
+            credentials.append((credential["client_id"], credential["client_secret"]))
+    return [BolCredential(client_id, client_secret) for client_id, client_secret in credentials]
+
+class RatingsUnavailable(Exception):
+    """The ratings of an EAN could not be fetched right now, the crawl retries it later."""
+
+class CredentialRejected(RatingsUnavailable):
+    """bol.com refused the credential itself: its token could not be refreshed or kept being rejected."""
+
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After", "")
+    return int(value) if value.isdigit() else None
+
+def acquire_breaker(breaker, deadline=None, cancelled=None):
+    """Wait for ``breaker`` to let a request through, for at most ``RATINGS_BREAKER_MAX_WAIT`` and
+    never past the crawl ``deadline``. Raises ``CircuitOpenError`` on timeout or when ``cancelled()``."""
+    give_up_at = time.monotonic() + RATINGS_BREAKER_MAX_WAIT
+    if deadline:
+        give_up_at = min(give_up_at, deadline)
+    while True:
+        if cancelled and cancelled():
+            raise resilience.CircuitOpenError(f"Stopped waiting for {breaker.name}, the run was cancelled.")
+        # Wait in short slices so a cancelled run does not sit in here for minutes
+        try:
+            breaker.acquire(timeout=max(min(give_up_at - time.monotonic(), RATINGS_BREAKER_POLL), 0))
+            return
+        except resilience.CircuitOpenError:
+            if time.monotonic() >= give_up_at:
+                raise
+
+def get_product_ratings(ean, headers, max_retries=3, client_id=BOL_CLIENT_ID, client_secret=BOL_CLIENT_SECRET,
+                        deadline=None, cancelled=None, limiter=None):
     logging.info(f"Fetching product ratings for EAN: {ean}")
     url = f"https://api.bol.com/retailer/products/{ean}/ratings"
+    breaker = resilience.breaker("bol_ratings", **RATINGS_BREAKER_SETTINGS)
+    # Rate limits are per API client, so a 429 only pauses the workers using the same credential
+    rate_limit_breaker = resilience.breaker(f"bol_ratings:{client_id}", **RATINGS_BREAKER_SETTINGS)
+    latency = resilience.latency_tracker("bol_ratings")
+    budget = resilience.hedge_budget("bol_ratings", ratio=RATINGS_HEDGE_RATIO)
+
+    def send():
+        started = time.monotonic()
+        response = http_session("bol").get(url, headers=dict(headers), timeout=RATINGS_TIMEOUT)
+        latency.record(time.monotonic() - started)
+        return response
+
     retries = 0
+    unauthorized = 0
     while retries < max_retries:
-        response = requests.get(url, headers=headers)
+        # Retries are requests like any other, so every attempt waits for its own token
+        if limiter:
+            limiter.take()
+        # Waits here while either breaker is open, together with every other crawl in the process
+        try:
+            acquire_breaker(rate_limit_breaker, deadline, cancelled)
+            try:
+                acquire_breaker(breaker, deadline, cancelled)
+            except resilience.CircuitOpenError:
+                rate_limit_breaker.release()
+                raise
+        except resilience.CircuitOpenError as e:
+            raise RatingsUnavailable(str(e))
+        try:
+            hedge_after = latency.percentile(RATINGS_HEDGE_PERCENTILE) if RATINGS_HEDGE_RATIO else None
+            # Bound so the request threads show up in the crawl's profile
+            response = resilience.hedged(profiling.bind(send), hedge_after, budget, limiter)
+        except requests.RequestException as e:
+            breaker.failure()
+            rate_limit_breaker.release()
+            logging.warning(f"Connection error for EAN {ean}: {e}")
+            time.sleep(resilience.backoff_delay(retries))
+            retries += 1
+            continue
         if response.status_code == 200:
+            breaker.success()
+            rate_limit_breaker.success()
             logging.info(f"Successfully fetched ratings for EAN: {ean}")
             return response.json(),headers['Authorization'].replace("Bearer ", "")
         # If response is 401 Unauthorized, reauthorize and retry
         elif response.status_code == 401:
+            breaker.release()
+            rate_limit_breaker.release()
             logging.warning(f"401 Unauthorized error for EAN {ean}. Reauthorizing...")
-            new_token = get_access_token()
+            new_token = get_access_token(client_id, client_secret)
+            if not new_token:
+                raise CredentialRejected("Could not refresh the access token")
             headers['Authorization'] = f"Bearer {new_token}"
+            unauthorized += 1
             retries += 1
             continue
         # If response is 404 Not Found, log and return None
         elif response.status_code == 404:
+            breaker.release()
+            rate_limit_breaker.release()
             logging.warning(f"404 Not Found error for EAN {ean}. Skipping this EAN.")
             return None,None
 
         elif response.status_code == 429:
+            # The rate limit applies to every worker on this client, so pause all of them rather than just this one
             retries += 1
-            wait_time = 30 * retries
-            logging.warning(f"429 Rate Limit hit for EAN {ean}. Retrying in {wait_time} seconds.")
-            time.sleep(wait_time)  # sleep for 60 seconds before retry
+            breaker.release()
+            rate_limit_breaker.failure(retry_after=retry_after_seconds(response), trip=True)
+            logging.warning(f"429 Rate Limit hit for EAN {ean}. Pausing all ratings requests of this client before retrying.")
             continue
         elif response.status_code == 400:
+            breaker.release()
+            rate_limit_breaker.release()
             logging.error(f"400 Bad Request for EAN {ean}. Response: {response.text}")
             return None, None
+        elif response.status_code >= 500:
+            breaker.failure()
+            rate_limit_breaker.release()
+            logging.warning(f"{response.status_code} Server error for EAN {ean}.")
+            time.sleep(resilience.backoff_delay(retries))
+            retries += 1
+            continue
         else:
-            logging.error(f"Unexpected error {response.status_code} for EAN {ean}")
-            return None, None
-def create_asana_tasks_from_excel(send_to_asana=True):
+            breaker.release()
+            rate_limit_breaker.release()
+            raise RatingsUnavailable(f"Unexpected status {response.status_code}")
+    if unauthorized > 1:
+        raise CredentialRejected(f"Unauthorized {unauthorized} times even with a fresh token")
+    raise RatingsUnavailable(f"Gave up after {max_retries} attempts")
+def list_asana_project_task_gids(headers, project_gid='1205436216136693'):
+    url = f"https://app.asana.com/api/1.0/projects/{project_gid}/tasks"
+    params = {"opt_fields": "gid", "limit": 100}
+    task_gids = []
+    while True:
+        response = http_session("asana").get(url, headers=headers, params=params)
+        response.raise_for_status()
+        body = response.json()
+        task_gids.extend(task["gid"] for task in body["data"])
+        if not body.get("next_page"):
+            return task_gids
+        params["offset"] = body["next_page"]["offset"]
+
+@profiling.profiled
+def create_asana_tasks_from_excel(send_to_asana=True, verify_ledger=False):
     print("create_asana_tasks_from_excel")
     if not send_to_asana:
         st.info("Task creation in Asana is disabled.")
@@ -342,11 +746,16 @@ def create_asana_tasks_from_excel(send_to_asana=True):
         "content-type": "application/json",
         "authorization": f"Bearer {ASANA_TOKEN}"
     }
+    if verify_ledger:
+        # Rows whose task was deleted in Asana since they were recorded are sent again
+        removed = asana_ledger.reconcile(list_asana_project_task_gids(headers))
+        logging.info(f"Asana ledger checked against the project, {removed} stale entries removed.")
+    skipped = 0
+    f1_row_hashes = []
 
     # Load the updated F1s Excel file
     input_file = st.session_state.output_file
-    for sheet_name in pd.ExcelFile(input_file).sheet_names:
-        df = pd.read_excel(input_file, sheet_name=sheet_name)
+    for sheet_name, df in read_workbook(input_file).items():
 
         # Check if 'EAN' column exists in the DataFrame
         if 'ean' not in df.columns:
@@ -372,12 +781,22 @@ def create_asana_tasks_from_excel(send_to_asana=True):
                 new_f1_sku = row['F1 to Use']
                 existing_f1_ean = row['ean']
                 new_f1_brand = row['GS1 Brand']
-                all_skus_data.append([task_name,sku_to_f1, new_f1_sku, existing_f1_ean,new_f1_barcode, new_f1_brand])
+                sku_data = [task_name,sku_to_f1, new_f1_sku, existing_f1_ean,new_f1_barcode, new_f1_brand]
+                # Skip rows an earlier run already sent with exactly this content
+                row_hash = asana_ledger.content_hash(sku_data)
+                if asana_ledger.is_recorded(asana_ledger.F1_ROW, sku_to_f1, row_hash):
+                    skipped += 1
+                    continue
+                all_skus_data.append(sku_data)
+                f1_row_hashes.append((sku_to_f1, row_hash))
             else:
                 if not pd.notna(row['F1 to Use']):
                     print(
                         f"EAN '{new_f1_barcode}' (data type: {type(new_f1_barcode)}) is not a valid value for SKU {row['sku']} in country Netherland. Skipping Asana task creation.")
-                    if row['sku'] not in unique_seller_skus:
+                    if asana_ledger.is_recorded(asana_ledger.NEW_F1_SUBTASK, row['sku'],
+                                                asana_ledger.content_hash([row['sku'], row['Sku description']])):
+                        skipped += 1
+                    elif row['sku'] not in unique_seller_skus:
                         unique_seller_skus.add(row['sku'])  # Add to the unique set
 
                         # Add to the list of tasks needing new EANs
@@ -385,6 +804,9 @@ def create_asana_tasks_from_excel(send_to_asana=True):
                             'Seller SKU': row['sku'],
                             'Sku description': row['Sku description']
                         })
+        if not all_skus_data:
+            logging.info(f"No new F1 rows in sheet {sheet_name}, not creating a BOL F1s task.")
+            continue
         # Create a DataFrame for the Excel file
         df_skus = pd.DataFrame(all_skus_data, columns=['Task','SKU to be F1', 'New F1 SKU', 'Existing F1 EAN','New F1 Barcode', 'New F1 Brand'])
 
@@ -407,7 +829,7 @@ def create_asana_tasks_from_excel(send_to_asana=True):
             }
         }
         # Create the task on Asana
-        response = requests.post(url, json=payload, headers=headers)
+        response = http_session("asana").post(url, json=payload, headers=headers)
         task_data = response.json()
         if 'data' in task_data and 'gid' in task_data['data']:
             task_gid = task_data['data']['gid']
@@ -415,7 +837,7 @@ def create_asana_tasks_from_excel(send_to_asana=True):
             section_gid = "1209105851510374"
             move_url = f"https://app.asana.com/api/1.0/sections/{section_gid}/addTask"
             move_payload = {"data": {"task": task_gid}}
-            requests.post(move_url, json=move_payload, headers=headers)
+            http_session("asana").post(move_url, json=move_payload, headers=headers)
             # Upload the CSV file as an attachment to the task
             # Adjust headers for file upload
             headers = {
@@ -424,10 +846,12 @@ def create_asana_tasks_from_excel(send_to_asana=True):
             upload_url = f"https://app.asana.com/api/1.0/tasks/{task_gid}/attachments"
             files = {'file': (
                 'bol_F1_sku_details.xlsx', output, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
-            attach_response = requests.post(upload_url, headers=headers, files=files)
+            attach_response = http_session("asana").post(upload_url, headers=headers, files=files)
 
             if attach_response.status_code == 200:
                 logging.info(f"Excel file successfully attached to task {task_gid}.")
+                for sku, row_hash in f1_row_hashes:
+                    asana_ledger.record(asana_ledger.F1_ROW, sku, row_hash, task_gid)
             else:
                 logging.error(f"Failed to upload the Excel file. Response: {attach_response.json()}")
 
@@ -442,14 +866,14 @@ def create_asana_tasks_from_excel(send_to_asana=True):
                 "followers": ["1208388789142367"],
             }
         }
-        main_task_response = requests.post(url, json=main_task_payload, headers=headers)
+        main_task_response = http_session("asana").post(url, json=main_task_payload, headers=headers)
         main_task_data = main_task_response.json()
         main_task_gid = main_task_data['data']['gid']
         # Move task to BOL section
         section_gid = "1209105851510374"
         move_url = f"https://app.asana.com/api/1.0/sections/{section_gid}/addTask"
         move_payload = {"data": {"task": main_task_gid}}
-        requests.post(move_url, json=move_payload, headers=headers)
+        http_session("asana").post(move_url, json=move_payload, headers=headers)
 
         # Create subtasks
         subtask_url = f"https://app.asana.com/api/1.0/tasks/{main_task_gid}/subtasks"
@@ -460,8 +884,15 @@ def create_asana_tasks_from_excel(send_to_asana=True):
                     "name": subtask_name
                 }
             }
-            subtask_response = requests.post(subtask_url, json=subtask_payload, headers=headers)
+            subtask_response = http_session("asana").post(subtask_url, json=subtask_payload, headers=headers)
             print(f"Added subtask: {subtask_name}. Response: {subtask_response.json()}")
+            if subtask_response.status_code == 201:
+                asana_ledger.record(asana_ledger.NEW_F1_SUBTASK, task['Seller SKU'],
+                                    asana_ledger.content_hash([task['Seller SKU'], task['Sku description']]),
+                                    main_task_gid)
+
+    if skipped:
+        st.info(f"Skipped {skipped} SKUs that were already sent to Asana with the same details.")
 
 # Initialize an empty set to store unique seller-skus
 unique_seller_skus = set()
@@ -469,8 +900,296 @@ unique_seller_skus = set()
 new_eans_needed = []
 # Prepare the list to store SKU details for CSV
 all_skus_data = []
+# The code each stage runs, its stored outputs are invalidated when any of it changes
+STAGE_CODE = {
+    "ratings": (unique_listings, update_excel_with_rating, get_product_ratings, normalize_cell),
+    "description": (sku_description_index, describe_sku, lookup_description),
+    "f1": (f1_index, find_f1_to_use, normalize_cell, lookup_f1),
+    "barcodes": (barcode_index, find_barcode, lookup_barcode),
+}
+
+def ratings_stage_key(listing, rating_threshold):
+    return stage_cache.key("ratings", stage_cache.code_version(*STAGE_CODE["ratings"]), content_hash(listing),
+                           rating_threshold)
+
+def stage_keys(inputs):
+    """Key of every stage output: its code, the inputs it reads and the keys of the stages before it."""
+    keys = {"ratings": ratings_stage_key(inputs["listing"], inputs["rating_threshold"])}
+    for stage, run_input, upstream, _, _ in LOOKUP_STAGES:
+        keys[stage] = stage_cache.key(stage, stage_cache.code_version(*STAGE_CODE[stage]),
+                                      content_hash(inputs[run_input]), *[keys[name] for name in upstream])
+    return keys
+
+def run_pipeline(job, inputs, profile_mode=None, refresh=False):
+    """Full ratings -> description -> F1 -> barcode chain, executed on the background worker pool.
+
+    A ``refresh`` that fetched no ratings produces no result, the served one is still as fresh.
+    """
+    if profile_mode:
+        with profiling.session(os.path.join(PROFILES_DIR, job.job_id), profile_mode):
+            return run_pipeline_stages(job, inputs, refresh)
+    return run_pipeline_stages(job, inputs, refresh)
+
+def crawl_and_enrich(job, inputs, indexes):
+    listing_df = analyze_listing(inputs["listing"])
+    credentials = [credential for credential in bol_credentials() if credential.refresh_token()]
+    if not credentials:
+        raise RuntimeError("Could not fetch a bol.com access token.")
+    enriched_rows = []
+    partial_path = job.result_path(".partial.jsonl")
+
+    def enrich(row):
+        enriched_rows.append(enrich_rating_row(row, indexes))
+        # Completed rows are visible in the UI while the crawl is still running
+        with open(partial_path, "a") as f:
+            f.write(json.dumps(enriched_rows[-1], default=str) + "\n")
+
+    _, coverage = update_excel_with_rating(listing_df, credentials, inputs["rating_threshold"], inputs["time_budget"],
+                                           job=job, max_rating_age=inputs["max_rating_age"], on_row=enrich)
+    return pd.DataFrame(enriched_rows, columns=ENRICHED_COLUMNS), coverage
+
+def run_pipeline_stages(job, inputs, refresh=False):
+    job.report(0, "Reading the listing feed.")
+    # Build the reference indexes up front, so every flagged product is enriched the moment its rating arrives
+    indexes = load_lookup_indexes(inputs)
+    keys = stage_keys(inputs)
+    # A stored crawl of the same listing is reused while it is as fresh as this run asks for
+    stored = stage_cache.load("ratings", keys["ratings"], max_age=inputs["max_rating_age"] or RUN_REUSE_TTL)
+    if stored is None:
+        results, coverage = crawl_and_enrich(job, inputs, indexes)
+        # Partial crawls are not stored, a rerun has to check the products they missed
+        if coverage["checked"] == coverage["total"]:
+            stage_cache.save("ratings", keys["ratings"], results[RATING_COLUMNS], coverage)
+            for stage, _, _, columns, _ in LOOKUP_STAGES:
+                stage_cache.save(stage, keys[stage], results[columns])
+    else:
+        results, coverage = stored
+        # Outputs stored before the rating age was kept are as old as the file
+        coverage = {"ratings_at": stage_cache.stored_at("ratings", keys["ratings"]), **coverage, "fetched": 0}
+        job.report(1.0, "Reusing the ratings of an earlier crawl of this listing.")
+        for stage, _, _, columns, lookup in LOOKUP_STAGES:
+            stored = stage_cache.load(stage, keys[stage])
+            if stored is None:
+                # Only the stages whose inputs changed since the stored outputs get here
+                job.report(message=f"Running the {stage} stage.")
+                rows = results.to_dict("records")
+                output = pd.DataFrame([lookup(row, indexes[stage]) for row in rows], columns=columns)
+                stage_cache.save(stage, keys[stage], output)
+            else:
+                output, _ = stored
+            for column in columns:
+                results[column] = output[column].to_numpy()
+    if coverage["total"] and not coverage["checked"]:
+        # Nothing to show for the run, so it should fail rather than finish with an empty result
+        raise RuntimeError(f"Ratings for none of the {coverage['total']} EANs could be fetched.")
+    job.coverage = coverage
+    job.data_at = coverage["ratings_at"]
+    if refresh and not coverage["fetched"]:
+        # Publishing the same ratings again would only make old data look new
+        job.summary = "No ratings were due for a recheck, the served results are unchanged."
+        return None
+    job.summary = f"Checked {coverage['checked']} of {coverage['total']} EANs ({coverage['percent']:.1f}% coverage)."
+    if coverage["failed"]:
+        job.summary += f" Ratings for {coverage['failed']} EANs could not be fetched."
+    if results.empty:
+        job.summary += f" No products rated {inputs['rating_threshold']} stars or lower were found."
+        return None
+    job.report(message="Writing the results.")
+    output = write_filtered_ratings(results.values.tolist(), ENRICHED_COLUMNS)
+    result_path = job.result_path()
+    with open(result_path, "wb") as f:
+        f.write(output.getvalue())
+    # Kept so a background refresh can rebuild these results without a new upload
+    with open(job.result_path(".barcodes.csv"), "wb") as f:
+        f.write(inputs["barcodes"])
+    with open(job.result_path(".settings.json"), "w") as f:
+        json.dump({"rating_threshold": inputs["rating_threshold"]}, f)
+    return result_path
+
+def start_background_refresh(latest):
+    """Revalidate the served results: stale EANs are fetched again and the rest come from the
+    rating history. Sessions that find the same stale results join the same refresh."""
+    base_path = os.path.splitext(latest["result_path"])[0]
+    if not os.path.exists(base_path + ".barcodes.csv"):
+        return None
+    # Refresh with the settings of the served run, results from before they were kept used the default
+    settings = {"rating_threshold": RATING_THRESHOLD}
+    if os.path.exists(base_path + ".settings.json"):
+        with open(base_path + ".settings.json") as f:
+            settings.update(json.load(f))
+    with open(base_path + ".barcodes.csv", "rb") as f:
+        inputs = collect_run_inputs(f.read(), settings["rating_threshold"], max_rating_age=RATINGS_TTL)
+    job_id, joined = jobs.submit_or_join("refresh", run_key(inputs), RESULTS_TTL, run_pipeline, inputs, refresh=True)
+    if not joined:
+        logging.info(f"Started background refresh {job_id} of results from job {latest['id']}.")
+    return job_id
+
+def format_age(seconds):
+    if seconds < 60:
+        return f"{int(seconds)} seconds"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} minutes"
+    if seconds < 2 * 86400:
+        return f"{seconds / 3600:.1f} hours"
+    return f"{int(seconds // 86400)} days"
+
+def estimate_run(rating_threshold=RATING_THRESHOLD, max_rating_age=None):
+    """Estimate the API calls and wall time of a run from local data only: the last downloaded
+    listing, the stored crawls, the rating history and the stats of recent crawls. Nothing is sent
+    to bol.com or Asana.
+    """
+    if not os.path.exists(LISTING_SNAPSHOT):
+        raise FileNotFoundError("No listing feed has been downloaded yet, start one run first.")
+    with open(LISTING_SNAPSHOT, encoding="utf-8", newline="") as f:
+        listing = f.read()
+    eans = list(unique_listings(analyze_listing(listing)))
+    history = ratings_history.load(eans)
+    # A run reuses a stored crawl of this listing as fresh as it asks for, see run_pipeline_stages
+    stored_at = stage_cache.stored_at("ratings", ratings_stage_key(listing, rating_threshold))
+    reuses_crawl = stored_at is not None and time.time() - stored_at <= (max_rating_age or RUN_REUSE_TTL)
+    if reuses_crawl:
+        to_fetch = []
+    elif max_rating_age:
+        fresh_after = time.time() - max_rating_age
+        to_fetch = [ean for ean in eans if ean not in history or history[ean]["checked_at"] < fresh_after]
+    else:
+        to_fetch = eans
+    # Each credential fetches an access token before a crawl, a reused one needs no bol.com calls at all
+    workers = len(bol_credentials())
+
+    # Requests per EAN and their latency as seen by recent crawls; without any, assume one request
+    # per EAN that is faster than the rate limit
+    crawls = ratings_history.recent_crawls()
+    crawled_eans = sum(crawl["eans"] for crawl in crawls)
+    requests_per_ean = sum(crawl["requests"] for crawl in crawls) / crawled_eans if crawled_eans else 1.0
+    latencies = [(crawl["mean_latency"], crawl["eans"]) for crawl in crawls if crawl["mean_latency"] is not None]
+    mean_latency = sum(l * n for l, n in latencies) / sum(n for _, n in latencies) if latencies else 0.0
+    # Every request, retries and hedges included, takes a rate limiter token of its worker's
+    # credential, and a worker sends its requests one after another
+    seconds_per_ean = max(requests_per_ean / RATINGS_RATE_PER_CREDENTIAL, requests_per_ean * mean_latency)
+    seconds = -(-len(to_fetch) // workers) * seconds_per_ean
+
+    # Products flagged last time are expected to be flagged again, unseen ones at the historical rate
+    flagged_before = sum(1 for entry in history.values() if ratings_history.has_low_rating(entry, rating_threshold))
+    flagged_rate = flagged_before / len(history) if history else 0.0
+    flagged = round(flagged_before + (len(eans) - len(history)) * flagged_rate)
+    return {
+        "eans": len(eans),
+        "to_fetch": len(to_fetch),
+        "workers": workers,
+        "bol_calls": 0 if reuses_crawl else workers + round(len(to_fetch) * requests_per_ean),
+        "reuses_crawl": reuses_crawl,
+        "flagged": flagged,
+        # At most one task, move and attachment for the F1 rows, and a task, move and subtask per
+        # product without an F1; rows the ledger shows as already sent need no calls at all
+        "asana_calls": (0, flagged + 5 if flagged else 0),
+        "seconds": seconds,
+        "crawls_observed": len(crawls),
+        "requests_per_ean": requests_per_ean,
+        "mean_latency": mean_latency,
+    }
+
+def format_estimate(estimate):
+    lines = [
+        f"{estimate['to_fetch']} of {estimate['eans']} listed EANs need their ratings fetched, "
+        f"over {estimate['workers']} bol.com credential(s).",
+        f"bol.com: about {estimate['bol_calls']} calls, taking about {format_age(estimate['seconds'])}.",
+        f"About {estimate['flagged']} products are expected to be flagged, "
+        f"Asana: {estimate['asana_calls'][0]} to {estimate['asana_calls'][1]} calls.",
+    ]
+    if estimate["reuses_crawl"]:
+        lines.insert(0, "A stored crawl of this listing is fresh enough to be reused, so it is not crawled again.")
+    if estimate["crawls_observed"]:
+        lines.append(f"Based on the last {estimate['crawls_observed']} crawl(s): "
+                     f"{estimate['requests_per_ean']:.2f} requests per EAN, {estimate['mean_latency']:.2f}s mean latency.")
+    else:
+        lines.append(f"No crawl has been recorded yet, assuming {RATINGS_RATE_PER_CREDENTIAL:g} EAN per second per credential.")
+    return lines
+
+@st.fragment(run_every=30)
+def show_latest_results(served_job_id):
+    latest = jobs.latest_result()
+    if latest is None:
+        return
+    if latest["id"] != served_job_id:
+        # A refresh published a newer version, serve that one instead
+        st.rerun()
+    # Results rebuilt from stored ratings are only as fresh as those ratings
+    age = time.time() - (latest["data_at"] or latest["updated_at"])
+    st.caption(f"Showing the latest results, with ratings checked up to {format_age(age)} ago. {latest['message'] or ''}")
+    if age > RESULTS_TTL:
+        refresh = jobs.find_active("refresh")
+        last_refresh = jobs.latest("refresh")
+        if refresh is None and last_refresh is not None and last_refresh["status"] == jobs.FAILED \
+                and time.time() - last_refresh["updated_at"] < REFRESH_RETRY_AFTER:
+            # Every open tab would otherwise start a new refresh that fails the same way
+            retry_in = REFRESH_RETRY_AFTER - (time.time() - last_refresh["updated_at"])
+            st.caption(f"The last background refresh failed ({last_refresh['error'] or last_refresh['message']}), "
+                       f"trying again in {format_age(retry_in)}.")
+            return
+        if refresh is None:
+            refresh_id = start_background_refresh(latest)
+            refresh = jobs.get(refresh_id) if refresh_id else None
+        if refresh is not None and refresh["status"] in jobs.ACTIVE_STATUSES:
+            st.caption(f"Refreshing in the background: {refresh['message']}")
+        elif refresh is None:
+            st.caption("Upload the barcode file to refresh these results.")
+
+def attach_job(job_id):
+    st.session_state.job_id = job_id
+    st.session_state.output_file = None
+    st.session_state.loaded_job_id = None
+    # Keep the run in the URL so a reopened tab reattaches to it
+    st.query_params["job"] = job_id
+
+def detach_job():
+    st.session_state.job_id = None
+    st.session_state.output_file = None
+    st.session_state.loaded_job_id = None
+    st.query_params.clear()
+
+@st.fragment(run_every=5)
+def show_job_status():
+    job = jobs.get(st.session_state.job_id)
+    if job is None:
+        st.warning("This run no longer exists.")
+        return
+    if job["status"] in jobs.ACTIVE_STATUSES:
+        st.progress(job["progress"], text=job["message"] or job["status"].capitalize())
+        partial_path = jobs.result_path(job["id"], ".partial.jsonl")
+        if os.path.exists(partial_path):
+            with open(partial_path) as f:
+                rows = [json.loads(line) for line in f]
+            st.caption(f"{len(rows)} products found so far")
+            st.dataframe(pd.DataFrame(rows, columns=ENRICHED_COLUMNS), hide_index=True)
+        if job["cancel_requested"]:
+            st.info("Cancelling...")
+        elif st.button("Cancel run"):
+            jobs.cancel(job["id"])
+        return
+    if job["status"] == jobs.DONE and st.session_state.loaded_job_id != job["id"]:
+        st.session_state.loaded_job_id = job["id"]
+        if job["result_path"] and os.path.exists(job["result_path"]):
+            with open(job["result_path"], "rb") as f:
+                st.session_state.output_file = BytesIO(f.read())
+        # Rerun the whole page so the download and Asana buttons appear
+        st.rerun()
+    if job["status"] == jobs.DONE:
+        st.info(job["message"])
+        profile_summary = os.path.join(PROFILES_DIR, job["id"], "summary.txt")
+        if os.path.exists(profile_summary):
+            with st.expander("Profile"):
+                with open(profile_summary) as f:
+                    st.code(f.read())
+                st.caption(f"Profiles and hotspot tables are in {os.path.dirname(profile_summary)}")
+    elif job["status"] == jobs.FAILED:
+        st.error(f"The run failed: {job['error'] or job['message']}")
+    elif job["status"] == jobs.CANCELLED:
+        st.warning("The run was cancelled.")
+
 def main():
     st.set_page_config(page_title="BOL File Processor", page_icon="📄")
+    recover_jobs()
 
     st.markdown(
         """
@@ -489,25 +1208,67 @@ def main():
         .stButton button:hover, .stDownloadButton button:hover {background-color: #45a049;}
         .stFileUploader {border: 2px dashed #4CAF50 !important; border-radius: 10px;}
         </style>""", unsafe_allow_html=True)
+    with st.sidebar:
+        if st.button("Refresh reference data"):
+            # Drop the cached sheets and indexes so the next run downloads them again
+            clear_reference_caches()
+            st.success("Reference data will be reloaded on the next run.")
+
+        recent_jobs = jobs.list_jobs()
+        if recent_jobs:
+            labels = {job["id"]: f"{time.strftime('%d %b %H:%M', time.localtime(job['created_at']))} - {job['status']}"
+                      for job in recent_jobs}
+            selected_job = st.selectbox("Recent runs", list(labels), format_func=labels.get)
+            if st.button("Attach to run"):
+                attach_job(selected_job)
+        budget_minutes = st.number_input("Crawl time budget (minutes, 0 = check every product)", min_value=0, value=0, step=5)
+        rating_threshold = st.selectbox("Flag products rated at or below", [1, 2, 3, 4], index=RATING_THRESHOLD - 1,
+                                        format_func=lambda stars: f"{stars} star" if stars == 1 else f"{stars} stars")
+        profile = st.checkbox("Profile pipeline stages", value=CLI_ARGS.profile)
+        profile_mode = st.selectbox("Profiler", profiling.MODES, index=profiling.MODES.index(CLI_ARGS.profile_mode),
+                                    disabled=not profile)
+        serve_latest = st.checkbox("Show the latest results while refreshing them", value=True)
+        if st.button("Estimate a run"):
+            # Dry run: only local data is read, no external service is called
+            try:
+                for title, max_rating_age in (("Full run", None), ("Background refresh", RATINGS_TTL)):
+                    st.info(f"**{title}**\n\n" + "\n\n".join(format_estimate(estimate_run(rating_threshold, max_rating_age))))
+            except FileNotFoundError as e:
+                st.warning(str(e))
+        if st.session_state.job_id and st.button("Start a new run"):
+            detach_job()
+
+    # Reattach to the run in the URL after the tab was closed or the connection dropped
+    if st.session_state.job_id is None and "job" in st.query_params:
+        attach_job(st.query_params["job"])
+
     # File uploader widget for the user to upload their barcodes file
     uploaded_barcodes = st.file_uploader("Upload Barcode CSV file", type="csv")
 
-    if uploaded_barcodes is not None and st.session_state.output_file is None:
-        # When a file is uploaded, run the analysis
-        with st.spinner("Processing your files. This may take a few moments..."):
-            listing_df = analyze_listing()
-            if listing_df is not None:
-                access_token = get_access_token()
-                if access_token:
-                    filtered_rating_data = update_excel_with_rating(listing_df,access_token)
-                    if filtered_rating_data:
-                        write_filtered_ratings(filtered_rating_data)
-                        update_excel_with_sku_description()
-                        time.sleep(5)
-                        update_excel_with_f1_to_use()
-                        time.sleep(15)
-                        update_excel_with_barcodes(uploaded_barcodes)
-                        time.sleep(15)
+    if uploaded_barcodes is not None and st.session_state.job_id is None:
+        # When a file is uploaded, hand the analysis to the background workers. A run with identical
+        # inputs that is still going or finished recently is joined instead of crawled again.
+        with st.spinner("Checking the listing and reference sheets..."):
+            inputs = collect_run_inputs(uploaded_barcodes.getvalue(), rating_threshold, budget_minutes * 60 or None)
+        if profile:
+            # A profile is only useful for a run that actually executes, so never join another run
+            job_id, joined = jobs.submit("pipeline", run_pipeline, inputs, profile_mode), False
+        else:
+            job_id, joined = jobs.submit_or_join("pipeline", run_key(inputs), RUN_REUSE_TTL, run_pipeline, inputs)
+        if joined:
+            st.info("An identical run was already started with these inputs, showing its results.")
+        attach_job(job_id)
+    if st.session_state.job_id is not None:
+        show_job_status()
+    elif uploaded_barcodes is None and serve_latest:
+        # Stale-while-revalidate: serve the most recent results at once and refresh them in the background
+        latest = jobs.latest_result()
+        if latest is not None and os.path.exists(latest["result_path"]):
+            if st.session_state.loaded_job_id != latest["id"]:
+                with open(latest["result_path"], "rb") as f:
+                    st.session_state.output_file = BytesIO(f.read())
+                st.session_state.loaded_job_id = latest["id"]
+            show_latest_results(latest["id"])
     # Check if the output file exists and show download button
     if st.session_state.output_file is not None:
         # Use Streamlit columns to place buttons side-by-side
@@ -519,10 +1280,26 @@ def main():
 
         # Column 2: Trigger Asana Functionality
         with col3:
+            verify_ledger = st.checkbox("Check for deleted tasks in Asana first")
             if st.button("Create Asana Tasks"):
                 st.info("Starting Asana task creation...")
-                create_asana_tasks_from_excel(send_to_asana=True)  # Call your function here
+                if profile:
+                    with profiling.session(os.path.join(PROFILES_DIR, f"asana-{int(time.time())}"), profile_mode):
+                        create_asana_tasks_from_excel(send_to_asana=True, verify_ledger=verify_ledger)
+                else:
+                    create_asana_tasks_from_excel(send_to_asana=True, verify_ledger=verify_ledger)  # Call your function here
                 st.success("Asana tasks created successfully!")
 
 if __name__ == "__main__":
-    main()
+    if CLI_ARGS.dry_run and not st.runtime.exists():
+        try:
+            for title, max_rating_age in (("Full run", None), ("Background refresh", RATINGS_TTL)):
+                estimate = estimate_run(max_rating_age=max_rating_age)
+                print(title)
+                for line in format_estimate(estimate):
+                    print(f"  {line}")
+        except FileNotFoundError as e:
+            # Printed to stderr with exit status 1
+            raise SystemExit(str(e))
+    else:
+        main()
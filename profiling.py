@@ -0,0 +1,231 @@
+"""Opt-in profiling of the pipeline stages.
+
+Stage functions are decorated with ``profiled``. Outside a profiling session the decorator only
+calls through. Inside one (see ``session``), every stage call writes to the session directory:
+
+- ``<stage>.pstats`` (deterministic mode, open with snakeviz or flameprof) or ``<stage>.folded``
+  (sampling mode, collapsed stacks for flamegraph.pl or speedscope),
+- ``<stage>.top.txt``, the top-N hotspots,
+- ``<stage>.alloc.txt``, the top-N allocation sites from a tracemalloc snapshot,
+
+and appends its wall time, CPU time and peak traced memory to ``summary.txt``. Threads a stage
+starts with a target wrapped in ``bind`` are profiled too and merged into the stage's profile.
+Memory tracing is process-wide, so stages that overlap share it and their peaks include each other.
+"""
+import contextvars
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+DETERMINISTIC = "deterministic"
+SAMPLING = "sampling"
+MODES = (DETERMINISTIC, SAMPLING)
+TOP_N = 25
+SAMPLE_INTERVAL = 0.005
+
+_active = contextvars.ContextVar("profiling_session", default=None)
+# The stage being profiled, set in the stage's own thread and in the threads it starts through ``bind``
+_stage = contextvars.ContextVar("profiling_stage", default=None)
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_started_tracing = False
+
+
+@contextmanager
+def session(directory, mode=DETERMINISTIC):
+    """Profile every ``profiled`` stage called in this thread until the block exits."""
+    os.makedirs(directory, exist_ok=True)
+    token = _active.set((directory, mode))
+    logging.info(f"Profiling stages ({mode}) into {directory}.")
+    try:
+        yield directory
+    finally:
+        _active.reset(token)
+
+
+def _write_top_stats(stats, path):
+    out = io.StringIO()
+    stats.stream = out
+    stats.sort_stats("cumulative").print_stats(TOP_N)
+    out.write("\n")
+    stats.sort_stats("tottime").print_stats(TOP_N)
+    with open(path, "w") as f:
+        f.write(out.getvalue())
+
+
+class _Sampler(threading.Thread):
+    """Samples the call stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id):
+        super().__init__(daemon=True, name="profiling-sampler")
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, folded_path, top_path):
+        with open(folded_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        total = sum(self.stacks.values()) or 1
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        with open(top_path, "w") as f:
+            for title, counter in (("Own time", own), ("Inclusive time", inclusive)):
+                f.write(f"{title} ({total} samples, {SAMPLE_INTERVAL * 1000:.0f} ms apart)\n")
+                for frame, count in counter.most_common(TOP_N):
+                    f.write(f"{100.0 * count / total:6.1f}%  {frame}\n")
+                f.write("\n")
+
+
+class _StageProfile:
+    """Profiles of the extra threads of one stage, collected while the stage runs."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        # Merged as every thread finishes, so a crawl of many short requests holds one set of stats
+        self.stats = None
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+
+    def run(self, func, *args, **kwargs):
+        if _stage.get() is self:
+            # Called directly in a thread that is already profiled for this stage
+            return func(*args, **kwargs)
+        token = _stage.set(self)
+        profiler = sampler = None
+        if self.mode == SAMPLING:
+            sampler = _Sampler(threading.get_ident())
+            sampler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if sampler:
+                sampler.stop()
+                with self._lock:
+                    self.stacks.update(sampler.stacks)
+            else:
+                profiler.disable()
+                with self._lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profiler)
+                    else:
+                        self.stats.add(profiler)
+            _stage.reset(token)
+
+
+def bind(func):
+    """Wrap ``func`` so that, when another thread runs it, it counts towards the current stage's
+    profile. Outside a profiled stage ``func`` is returned unchanged."""
+    stage = _stage.get()
+    if stage is None:
+        return func
+    return functools.partial(stage.run, func)
+
+
+def _start_tracing():
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        _tracing_users += 1
+        tracemalloc.reset_peak()
+        return tracemalloc.take_snapshot()
+
+
+def _stop_tracing():
+    """Snapshot and peak for a stage that finished; tracing stops once no stage uses it anymore."""
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracing_users -= 1
+        if _tracing_users == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+        return snapshot, peak
+
+
+def _write_allocations(before, after, path):
+    with open(path, "w") as f:
+        f.write(f"Top {TOP_N} allocation sites by growth during the stage\n")
+        for stat in after.compare_to(before, "lineno")[:TOP_N]:
+            f.write(f"{stat}\n")
+
+
+def profiled(func):
+    """Profile ``func`` as a pipeline stage whenever a profiling session is active."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        active = _active.get()
+        if active is None:
+            return func(*args, **kwargs)
+        directory, mode = active
+        stage = func.__name__
+        before = _start_tracing()
+        threads = _StageProfile(mode)
+        stage_token = _stage.set(threads)
+        profiler = sampler = None
+        if mode == SAMPLING:
+            sampler = _Sampler(threading.get_ident())
+            sampler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall, cpu = time.perf_counter() - wall_started, time.process_time() - cpu_started
+            _stage.reset(stage_token)
+            if sampler:
+                sampler.stop()
+                sampler.stacks.update(threads.stacks)
+                sampler.write(os.path.join(directory, f"{stage}.folded"), os.path.join(directory, f"{stage}.top.txt"))
+            else:
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+                if threads.stats is not None:
+                    stats.add(threads.stats)
+                stats.dump_stats(os.path.join(directory, f"{stage}.pstats"))
+                _write_top_stats(stats, os.path.join(directory, f"{stage}.top.txt"))
+            after, peak = _stop_tracing()
+            _write_allocations(before, after, os.path.join(directory, f"{stage}.alloc.txt"))
+            with open(os.path.join(directory, "summary.txt"), "a") as f:
+                f.write(f"{stage}: wall {wall:.2f}s, cpu {cpu:.2f}s, peak traced memory {peak / 2 ** 20:.1f} MiB\n")
+            logging.info(f"Profiled {stage}: wall {wall:.2f}s, cpu {cpu:.2f}s.")
+
+    return wrapper
@@ -0,0 +1,114 @@
+"""Rating history for every EAN the crawl has checked.
+
+Each successful ratings fetch is stored with its rating distribution and the time it was
+checked. The crawl uses this to visit the products most likely to turn up a low rating first.
+Every crawl also leaves a summary of its request counts and latencies, which the dry-run
+estimate in ``main`` uses to predict how long the next crawl will take.
+"""
+import json
+import time
+
+import storage
+
+# A check this many days old counts double towards the priority of a product
+STALE_AFTER_DAYS = 7
+
+
+def _create_tables(conn):
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS ratings (
+            ean INTEGER PRIMARY KEY,
+            ratings TEXT NOT NULL,
+            rating_count INTEGER NOT NULL,
+            checked_at REAL NOT NULL
+        )"""
+    )
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS crawls (
+            finished_at REAL NOT NULL,
+            eans INTEGER NOT NULL,
+            requests INTEGER NOT NULL,
+            workers INTEGER NOT NULL,
+            elapsed REAL NOT NULL,
+            mean_latency REAL
+        )"""
+    )
+
+
+_database = storage.Database("ratings_history.sqlite3", _create_tables)
+
+
+def record(ean, ratings, checked_at=None):
+    """Store the rating distribution (the ``ratings`` list of the API response) for an EAN."""
+    rating_count = sum(r['count'] for r in ratings)
+    with _database.write_lock, _database.connection() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO ratings (ean, ratings, rating_count, checked_at) VALUES (?, ?, ?, ?)",
+            (int(ean), json.dumps(ratings), rating_count, checked_at or time.time()),
+        )
+
+
+def load(eans):
+    """Return ``{ean: {"ratings", "rating_count", "checked_at"}}`` for the EANs seen before."""
+    history = {}
+    eans = [int(ean) for ean in eans]
+    with _database.connection() as conn:
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(eans), 500):
+            chunk = eans[start:start + 500]
+            rows = conn.execute(
+                f"SELECT * FROM ratings WHERE ean IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for row in rows:
+                history[row["ean"]] = {
+                    "ratings": json.loads(row["ratings"]),
+                    "rating_count": row["rating_count"],
+                    "checked_at": row["checked_at"],
+                }
+    return history
+
+
+def has_low_rating(entry, rating_threshold):
+    return any(r['rating'] <= rating_threshold and r['count'] > 0 for r in entry["ratings"])
+
+
+def low_rating_likelihood(entry, rating_threshold):
+    """Rough chance that a product has a rating at or below the threshold on its next check."""
+    if has_low_rating(entry, rating_threshold):
+        # Low ratings rarely disappear, so last time's findings are the most likely ones again
+        return 1.0
+    # Otherwise a product with few ratings can flip with a single review, one with many rarely does
+    return 1.0 / (entry["rating_count"] + 2)
+
+
+def prioritize(eans, rating_threshold, now=None):
+    """Order EANs for crawling: never-seen products first (in their original order), then the
+    rest by low-rating likelihood, weighted up the longer ago they were checked."""
+    now = now or time.time()
+    history = load(eans)
+
+    def priority(ean):
+        entry = history.get(int(ean))
+        if entry is None:
+            return float("inf")
+        age_days = max(now - entry["checked_at"], 0) / 86400
+        return low_rating_likelihood(entry, rating_threshold) * (1 + age_days / STALE_AFTER_DAYS)
+
+    # sorted() is stable, so ties keep the feed order
+    return sorted(eans, key=priority, reverse=True)
+
+
+def record_crawl(eans, requests, workers, elapsed, mean_latency):
+    """Store how a crawl went: EANs fetched from the API, requests sent for them (retries and
+    hedges included), worker threads, wall time and mean request latency."""
+    with _database.write_lock, _database.connection() as conn:
+        conn.execute(
+            "INSERT INTO crawls (finished_at, eans, requests, workers, elapsed, mean_latency) VALUES (?, ?, ?, ?, ?, ?)",
+            (time.time(), eans, requests, workers, elapsed, mean_latency),
+        )
+
+
+def recent_crawls(limit=5):
+    with _database.connection() as conn:
+        rows = conn.execute("SELECT * FROM crawls ORDER BY finished_at DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,256 @@
+"""Shared protection for the upstream APIs.
+
+One circuit breaker per upstream service is shared by every worker thread in the process, so
+when a service starts failing all in-flight crawls back off together instead of each one
+hammering it on its own schedule. Latency is tracked per service as well, so a request that
+runs past the usual p95 can be hedged with a duplicate instead of stalling the crawl.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised when a request could not get through the breaker in time."""
+
+
+class CircuitBreaker:
+    """Counts consecutive failures of a service and stops all traffic to it after too many.
+
+    While open every caller waits in ``acquire``. When the pause is over a single probe request
+    is let through; if it succeeds the number of concurrent requests allowed doubles with every
+    further success until ``ramp_limit`` is reached and the breaker closes again. A failure
+    while probing or ramping reopens it with a doubled pause (up to ``max_reset_timeout``).
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, max_reset_timeout=600.0, ramp_limit=8):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.ramp_limit = ramp_limit
+        self.state = CLOSED
+        self._cond = threading.Condition()
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0.0
+        self._allowed = None  # concurrent requests allowed while half open, None means unlimited
+        self._in_flight = 0
+
+    def acquire(self, timeout=None):
+        """Block until a request may be sent, raise ``CircuitOpenError`` after ``timeout`` seconds."""
+        give_up_at = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.state == OPEN and now >= self._open_until:
+                    logging.info(f"Circuit for {self.name} half open, sending a probe request.")
+                    self.state = HALF_OPEN
+                    self._allowed = 1
+                if self.state != OPEN and (self._allowed is None or self._in_flight < self._allowed):
+                    self._in_flight += 1
+                    return
+                wait = self._open_until - now if self.state == OPEN else 1.0
+                if give_up_at is not None:
+                    if now >= give_up_at:
+                        raise CircuitOpenError(f"Circuit for {self.name} is open.")
+                    wait = min(wait, give_up_at - now)
+                self._cond.wait(max(wait, 0.01))
+
+    def success(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._failures = 0
+            if self.state == HALF_OPEN:
+                self._allowed *= 2
+                if self._allowed >= self.ramp_limit:
+                    logging.info(f"Circuit for {self.name} closed again.")
+                    self.state = CLOSED
+                    self._allowed = None
+                    self._trips = 0
+            self._cond.notify_all()
+
+    def failure(self, retry_after=None, trip=False):
+        """Record a failed request. ``trip`` opens the breaker straight away, e.g. on a rate limit
+        that applies to every worker; ``retry_after`` is the pause the service asked for."""
+        with self._cond:
+            self._in_flight -= 1
+            self._failures += 1
+            if trip or self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._open(retry_after)
+            self._cond.notify_all()
+
+    def release(self):
+        """Give back a slot without judging the service, e.g. after a 404 or a 401."""
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _open(self, retry_after):
+        pause = min(self.reset_timeout * 2 ** self._trips, self.max_reset_timeout)
+        if retry_after:
+            pause = max(pause, retry_after)
+        # Several workers can fail at once, only the first one decides how long the pause is
+        if self.state != OPEN:
+            self._trips += 1
+            self.state = OPEN
+            self._open_until = time.monotonic() + pause
+            self._failures = 0
+            logging.warning(f"Circuit for {self.name} opened after repeated failures, pausing for {pause:.0f} seconds.")
+
+
+_breakers = {}
+_registry_lock = threading.Lock()
+
+
+def breaker(service, **settings):
+    """Return the process-wide breaker for ``service``, creating it with ``settings`` on first use."""
+    with _registry_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(service, **settings)
+        return _breakers[service]
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Full-jitter exponential backoff, so workers that failed together do not retry together."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Rolling window of recent request latencies for one service."""
+
+    def __init__(self, window=500, min_samples=20):
+        self.min_samples = min_samples
+        self.count = 0  # requests recorded since the process started
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def mean(self):
+        with self._lock:
+            return sum(self._samples) / len(self._samples) if self._samples else None
+
+    def percentile(self, pct):
+        """Observed latency at ``pct`` (0-100), or ``None`` until enough requests have been seen."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+class HedgeBudget:
+    """Caps duplicate requests at ``ratio`` of all requests, so hedging stays inside the rate limit."""
+
+    def __init__(self, ratio=0.05, burst=5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_spend(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+class TokenBucket:
+    """Blocking rate limiter: ``rate`` requests per second with bursts of up to ``capacity``."""
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        while True:
+            wait = self._try_take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_take(self):
+        """Take a token if one is available right now, without waiting."""
+        return not self._try_take()
+
+    def _try_take(self):
+        # Returns 0 when a token was taken, otherwise how long until the next one is available
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="bol-hedge")
+
+
+def hedged(call, hedge_after, budget, limiter=None):
+    """Run ``call()``; if it has not returned after ``hedge_after`` seconds and the budget allows,
+    start a duplicate and return whichever finishes first (preferring one that succeeded). With a
+    ``limiter`` the duplicate also needs one of its tokens, so hedging never exceeds the rate limit."""
+    budget.earn()
+    if hedge_after is None:
+        return call()
+    primary = _hedge_executor.submit(call)
+    try:
+        return primary.result(timeout=hedge_after)
+    except TimeoutError:
+        pass
+    if not budget.try_spend() or (limiter is not None and not limiter.try_take()):
+        return primary.result()
+    logging.info(f"Request still running after {hedge_after:.2f} seconds, sending a hedge request.")
+    backup = _hedge_executor.submit(call)
+    done, pending = wait([primary, backup], return_when=FIRST_COMPLETED)
+    first = done.pop()
+    if first.exception() is not None and pending:
+        return pending.pop().result()
+    return first.result()
+
+
+_trackers = {}
+_budgets = {}
+_limiters = {}
+
+
+def latency_tracker(service):
+    with _registry_lock:
+        if service not in _trackers:
+            _trackers[service] = LatencyTracker()
+        return _trackers[service]
+
+
+def rate_limiter(name, rate):
+    with _registry_lock:
+        if name not in _limiters:
+            _limiters[name] = TokenBucket(rate)
+        return _limiters[name]
+
+
+def hedge_budget(service, **settings):
+    with _registry_lock:
+        if service not in _budgets:
+            _budgets[service] = HedgeBudget(**settings)
+        return _budgets[service]
@@ -0,0 +1,36 @@
+"""Work-stealing distribution of crawl work over several workers.
+
+Each worker owns a deque, filled round-robin from the priority-ordered work list so every worker
+starts on the most promising items. A worker takes from the front of its own deque and, once it
+runs dry, steals from the back (the least promising end) of the fullest other deque. Items of a
+worker that stops early are therefore picked up by the others.
+"""
+import threading
+from collections import deque
+
+
+class WorkStealingQueues:
+    def __init__(self, items, workers):
+        self._queues = [deque() for _ in range(workers)]
+        for position, item in enumerate(items):
+            self._queues[position % workers].append(item)
+        self._lock = threading.Lock()
+
+    def take(self, worker):
+        """Next item for ``worker``, or ``None`` when every queue is empty."""
+        with self._lock:
+            own = self._queues[worker]
+            if own:
+                return own.popleft()
+            victim = max(self._queues, key=len)
+            if victim:
+                return victim.pop()
+            return None
+
+    def drain(self):
+        """Remove and return every item not taken yet."""
+        with self._lock:
+            remaining = [item for queue in self._queues for item in queue]
+            for queue in self._queues:
+                queue.clear()
+            return remaining
@@ -0,0 +1,82 @@
+"""Stored outputs of the pipeline stages, make-style.
+
+Every stage output is saved as a Parquet file under a key that hashes the stage's code and
+everything it reads: the reference data it uses and the keys of the stages it depends on. A run
+recomputes the keys and only executes the stages whose key has no stored output yet, so a new
+barcode file reruns the barcode lookup but not the multi-hour ratings crawl before it.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+import storage
+
+STAGES_DIR = os.path.join(storage.DATA_DIR, "stages")
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(*funcs):
+    """Hash of the source of the functions a stage runs, so editing one invalidates its outputs."""
+    digest = hashlib.sha256()
+    for func in funcs:
+        digest.update(inspect.getsource(func).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def key(stage, *parts):
+    return hashlib.sha256(json.dumps([stage, *[str(part) for part in parts]]).encode("utf-8")).hexdigest()
+
+
+def _paths(stage, stage_key):
+    base = os.path.join(STAGES_DIR, stage, stage_key)
+    return base + ".parquet", base + ".json"
+
+
+def _plain(value):
+    # numpy scalars to the Python values json can write
+    return value.item() if hasattr(value, "item") else value
+
+
+def save(stage, stage_key, df, meta=None):
+    """Store ``df`` as the output of ``stage`` under ``stage_key``, with an optional ``meta`` dict."""
+    parquet_path, meta_path = _paths(stage, stage_key)
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    df = df.reset_index(drop=True)
+    # Parquet columns have one type, so columns mixing e.g. numeric and text SKUs are stored as JSON
+    json_columns = [column for column in df.columns if df[column].dtype == object
+                    and len({type(_plain(value)) for value in df[column] if pd.notna(value)}) > 1]
+    for column in json_columns:
+        df[column] = [json.dumps(_plain(value) if pd.notna(value) else None) for value in df[column]]
+    df.to_parquet(parquet_path + ".tmp", index=False)
+    with open(meta_path, "w") as f:
+        json.dump({"meta": meta or {}, "json_columns": json_columns}, f)
+    os.replace(parquet_path + ".tmp", parquet_path)
+    logging.info(f"Stored {stage} output {stage_key[:12]} ({len(df)} rows).")
+
+
+def stored_at(stage, stage_key):
+    """Time the output of ``stage`` under ``stage_key`` was stored, or ``None`` if there is none."""
+    parquet_path, _ = _paths(stage, stage_key)
+    return os.path.getmtime(parquet_path) if os.path.exists(parquet_path) else None
+
+
+def load(stage, stage_key, max_age=None):
+    """Return ``(df, meta)`` stored for ``stage`` under ``stage_key``, or ``None`` if there is none
+    or it is older than ``max_age`` seconds."""
+    parquet_path, meta_path = _paths(stage, stage_key)
+    stored_time = stored_at(stage, stage_key)
+    if stored_time is None or (max_age is not None and time.time() - stored_time > max_age):
+        return None
+    df = pd.read_parquet(parquet_path)
+    with open(meta_path) as f:
+        stored = json.load(f)
+    for column in stored["json_columns"]:
+        df[column] = [json.loads(value) for value in df[column]]
+    logging.info(f"Reusing stored {stage} output {stage_key[:12]} ({len(df)} rows).")
+    return df, stored["meta"]
@@ -0,0 +1,41 @@
+"""The app's local data directory and the SQLite databases kept in it.
+
+Jobs, rating history, the Asana ledger, stage outputs and profiles all live under one directory,
+``BOL_FS_DATA_DIR`` (``.bol_fs`` by default), so a deployment only has to persist that.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DATA_DIR = os.environ.get("BOL_FS_DATA_DIR", ".bol_fs")
+
+
+class Database:
+    """One SQLite file in the data directory.
+
+    ``create_tables(conn)`` is run on every new connection and must be idempotent. Writers take
+    ``write_lock`` so threads of this process do not wait on SQLite's file lock for each other.
+    """
+
+    def __init__(self, filename, create_tables):
+        self.path = os.path.join(DATA_DIR, filename)
+        self.create_tables = create_tables
+        self.write_lock = threading.Lock()
+
+    def connect(self):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        self.create_tables(conn)
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Connection that commits when the block succeeds and is closed either way."""
+        conn = self.connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
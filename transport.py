@@ -0,0 +1,173 @@
+"""Record and replay of every HTTP exchange the pipeline makes.
+
+All upstream calls go through the ``requests`` sessions created in ``main.http_session``, and
+this module decides which transport adapter those sessions use. With ``BOL_FS_TRANSPORT`` unset
+they talk to the network as usual. ``record:<cassette>`` also appends every exchange to a
+gzip-compressed JSON-lines cassette, and ``replay:<cassette>[:<latency>]`` answers every request
+from that cassette without touching the network. ``<latency>`` is ``original`` (sleep as long as
+the recorded request took, the default), ``none``, or a fixed number of seconds.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+LIVE = "live"
+RECORD = "record"
+REPLAY = "replay"
+
+
+def _body_hash(body):
+    if body is None:
+        return None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if not isinstance(body, bytes):
+        # Streamed bodies cannot be hashed up front, they are matched on method and URL only
+        return None
+    return hashlib.sha256(body).hexdigest()
+
+
+def _redact(content):
+    # Tokens from the auth endpoints must not end up on disk
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if isinstance(data, dict) and "access_token" in data:
+        data["access_token"] = "recorded-token"
+        return json.dumps(data).encode("utf-8")
+    return content
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests to the network and appends each exchange to the cassette."""
+
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        started = time.monotonic()
+        response = super().send(request, **kwargs)
+        elapsed = time.monotonic() - started
+        exchange = {
+            "method": request.method,
+            "url": request.url,
+            "body_hash": _body_hash(request.body),
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "content": base64.b64encode(_redact(response.content)).decode("ascii"),
+            "elapsed": elapsed,
+        }
+        line = (json.dumps(exchange) + "\n").encode("utf-8")
+        with self._lock:
+            # Every write is its own gzip member, concatenated members still read as one stream
+            with open(self.cassette, "ab") as f:
+                f.write(gzip.compress(line))
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from a cassette, in the order they were recorded."""
+
+    def __init__(self, cassette, latency="original"):
+        super().__init__()
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._exact = defaultdict(deque)
+        self._by_url = defaultdict(deque)
+        with gzip.open(cassette, "rt", encoding="utf-8") as f:
+            for line in f:
+                exchange = json.loads(line)
+                self._exact[(exchange["method"], exchange["url"], exchange["body_hash"])].append(exchange)
+                self._by_url[(exchange["method"], exchange["url"])].append(exchange)
+        logging.info(f"Replaying {sum(len(q) for q in self._by_url.values())} recorded exchanges from {cassette}.")
+
+    def _next(self, queue):
+        # The last recording for a request keeps answering once the earlier ones are used up
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            exact = self._exact.get((request.method, request.url, _body_hash(request.body)))
+            by_url = self._by_url.get((request.method, request.url))
+            if exact:
+                exchange = self._next(exact)
+            elif by_url:
+                exchange = self._next(by_url)
+            else:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+        if self.latency == "original":
+            time.sleep(exchange["elapsed"])
+        elif self.latency != "none":
+            time.sleep(float(self.latency))
+
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.headers = CaseInsensitiveDict(exchange["headers"])
+        # The recorded body is already decoded, so the original content encoding no longer applies
+        response.headers.pop("Content-Encoding", None)
+        response._content = base64.b64decode(exchange["content"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.reason = ""
+        response.elapsed = timedelta(seconds=exchange["elapsed"])
+        return response
+
+    def close(self):
+        pass
+
+
+def parse_mode(setting=None):
+    """Split a ``BOL_FS_TRANSPORT`` value into ``(mode, cassette, latency)``."""
+    setting = setting if setting is not None else os.environ.get("BOL_FS_TRANSPORT", "")
+    if not setting:
+        return LIVE, None, None
+    mode, _, rest = setting.partition(":")
+    if mode == RECORD and rest:
+        return RECORD, rest, None
+    if mode == REPLAY and rest:
+        cassette, _, latency = rest.partition(":")
+        return REPLAY, cassette, latency or "original"
+    raise ValueError(f"BOL_FS_TRANSPORT must be record:<cassette> or replay:<cassette>[:<latency>], got {setting!r}")
+
+
+_replay_adapters = {}
+_recording_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+def mount(session, setting=None, pool_connections=4, pool_maxsize=16):
+    """Mount the adapter for the configured transport mode on ``session`` and return the mode."""
+    mode, cassette, latency = parse_mode(setting)
+    if mode == LIVE:
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    else:
+        # All sessions share one adapter per cassette, so recordings land in one file and replay
+        # consumes one queue of exchanges
+        with _adapters_lock:
+            if mode == RECORD:
+                if cassette not in _recording_adapters:
+                    _recording_adapters[cassette] = RecordingAdapter(
+                        cassette, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+                adapter = _recording_adapters[cassette]
+            else:
+                if (cassette, latency) not in _replay_adapters:
+                    _replay_adapters[(cassette, latency)] = ReplayAdapter(cassette, latency)
+                adapter = _replay_adapters[(cassette, latency)]
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return mode